@@ -134,16 +134,93 @@ index = {"plot_bipartite": "api.ipynb",
          "Formatter": "utils.ipynb",
          "bb2b": "utils.ipynb",
          "b_ls": "utils.ipynb",
-         "b_l_intersect": "utils.ipynb"}
+         "b_l_intersect": "utils.ipynb",
+         "is_ps_in_bs": "utils.ipynb",
+         "pmm_batch": "utils.ipynb",
+         "condition_mat_batch": "utils.ipynb",
+         "conic2ellipse_batch": "utils.ipynb",
+         "wlstsq_batch": "utils.ipynb",
+         "checker_opencv_batch": "control_refine.ipynb",
+         "fit_conic_batch": "control_refine.ipynb",
+         "ellipse_dualconic_batch": "control_refine.ipynb",
+         "euler2R_batch": "utils.ipynb",
+         "heikkila97_distort": "modules.ipynb",
+         "wang08_distort": "modules.ipynb",
+         "Rig": "modules.ipynb",
+         "rig_loss": "calib.ipynb",
+         "lm_optimize": "calib.ipynb",
+         "rig_optimize": "calib.ipynb",
+         "euler2R_jacobian_batch": "utils.ipynb",
+         "assert_jacobian": "modules.ipynb",
+         "heikkila97_distort_jacobian": "modules.ipynb",
+         "wang08_distort_jacobian": "modules.ipynb",
+         "ArrayCache": "image.ipynb",
+         "Array16bit": "image.ipynb",
+         "grad_array_batch": "utils.ipynb",
+         "label_centroids": "fiducial_detect.ipynb",
+         "update_hash": "cache.ipynb",
+         "hash_obj": "cache.ipynb",
+         "hash_file": "cache.ipynb",
+         "hash_img": "cache.ipynb",
+         "DiskCache": "cache.ipynb",
+         "cached": "cache.ipynb",
+         "detect_imgs": "calib.ipynb",
+         "iter_detect_imgs": "calib.ipynb",
+         "iter_refine_imgs": "calib.ipynb",
+         "refine_imgs": "calib.ipynb",
+         "calib_cams": "calib.ipynb",
+         "FORMAT_VERSION": "params.ipynb",
+         "save_params": "params.ipynb",
+         "load_params": "params.ipynb",
+         "Projector": "runtime.ipynb",
+         "load_projector": "runtime.ipynb",
+         "benchmark_import": "benchmark.ipynb",
+         "torch_only": "utils.ipynb",
+         "benchmark_numpyify": "benchmark.ipynb",
+         "load_calib": "benchmark.ipynb",
+         "reprojection_rms": "benchmark.ipynb",
+         "compare_calibs": "benchmark.ipynb",
+         "benchmark_calib": "benchmark.ipynb",
+         "benchmark_detect": "benchmark.ipynb",
+         "benchmark_suite": "benchmark.ipynb",
+         "main": "benchmark.ipynb",
+         "synth_scene": "synth.ipynb",
+         "synth_occluders": "synth.ipynb",
+         "synth_ps": "synth.ipynb",
+         "synth_obs": "synth.ipynb",
+         "synth_array": "synth.ipynb",
+         "SynthImg": "synth.ipynb",
+         "synth_imgs": "synth.ipynb",
+         "write_imgs": "synth.ipynb",
+         "SynthDetector": "synth.ipynb",
+         "hook": "hooks.ipynb",
+         "hooked": "hooks.ipynb",
+         "replay": "hooks.ipynb",
+         "stage": "hooks.ipynb",
+         "counter": "hooks.ipynb",
+         "Tracer": "hooks.ipynb",
+         "trace": "hooks.ipynb",
+         "print_progress": "calib.ipynb",
+         "homography_batch": "utils.ipynb",
+         "approx_R_batch": "utils.ipynb",
+         "init_intrin_batch": "calib.ipynb",
+         "init_extrin_batch": "calib.ipynb",
+         "Obs": "calib.ipynb"}
 
 modules = ["api.py",
+           "benchmark.py",
+           "cache.py",
            "calib.py",
            "cb_geom.py",
            "control_refine.py",
            "fiducial_detect.py",
+           "hooks.py",
            "image.py",
            "modules.py",
+           "params.py",
            "plot.py",
+           "runtime.py",
+           "synth.py",
            "utils.py"]
 
 doc_url = "https://justinblaber.github.io/camera_calib/"
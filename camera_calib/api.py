@@ -3,11 +3,13 @@
 __all__ = ['plot_bipartite', 'plot_residuals', 'plot_extrinsics', 'save', 'load']
 
 # Cell
+from .cache import DiskCache
 from .calib import multi_calib
 from .cb_geom import CbGeom, CpCSRGrid, FmCFPGrid
 from .control_refine import OpenCVCheckerRefiner
 from .fiducial_detect import DotVisionCheckerDLDetector
-from .image import File16bitImg
+from .image import ArrayCache, File16bitImg
+from .params import load_params, save_params
 
 # Cell
 def plot_bipartite(calib, ax=None):
@@ -18,12 +20,16 @@ def plot_bipartite(calib, ax=None):
 # Cell
 def plot_residuals(calib, ax=None):
     import matplotlib.pyplot as plt
+    import torch
 
     if ax == None: _, ax = plt.subplots(1, 1, figsize=(6,6))
 
-    for p1, p2 in zip(calib['pss_c_p'], calib['pss_c_p_m']):
-        res = p1-p2
-        plt.plot(res[:,0], res[:,1], 's')
+    if 'obs' in calib:
+        obs = calib['obs']
+        rss = obs.split(obs.ps_c_p-obs.pack(torch.stack(calib['pss_c_p_m'])))
+    else: # Calibrations saved before observations were packed; non finite points are not plotted
+        rss = [ps_c_p-ps_c_p_m for ps_c_p, ps_c_p_m in zip(calib['pss_c_p'], calib['pss_c_p_m'])]
+    for rs_img in rss: ax.plot(rs_img[:,0], rs_img[:,1], 's')
     ax.set_aspect(1)
     ax.set_xlim(-0.25, 0.25)
     ax.set_ylim(-0.25, 0.25)
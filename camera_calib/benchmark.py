@@ -0,0 +1,233 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: benchmark.ipynb (unless otherwise specified).
+
+__all__ = ['benchmark_import', 'benchmark_numpyify', 'load_calib', 'reprojection_rms', 'compare_calibs',
+           'benchmark_calib', 'benchmark_detect', 'benchmark_suite', 'main']
+
+# Cell
+import io
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import time
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+
+from .hooks import hook, trace
+
+# Cell
+def benchmark_import(name, n=5):
+    code = (f'import json, sys, time; t = time.perf_counter(); import {name}; t = time.perf_counter() - t; '
+            "print(json.dumps({'time': t, 'modules': sorted({m.split('.')[0] for m in sys.modules})}))")
+    results = [json.loads(subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE).stdout)
+               for _ in range(n)]
+    return {'name': name, 'time': min(r['time'] for r in results), 'modules': results[0]['modules']}
+
+# Cell
+def benchmark_numpyify(n=10000):
+    import timeit
+
+    import torch
+
+    from .utils import bb_grid, bb_sz, pld, stackify, torch_only, unitize
+
+    p, l = torch.tensor([3., 4.], dtype=torch.double), torch.tensor([1., 2., 3.], dtype=torch.double)
+    bb = torch.tensor([[1., 2.], [10., 20.]], dtype=torch.double)
+    fs = {'stackify': lambda: stackify((p, p)),
+          'unitize':  lambda: unitize(p),
+          'pld':      lambda: pld(p, l),
+          'bb_sz':    lambda: bb_sz(bb),
+          'bb_grid':  lambda: bb_grid(bb)}
+
+    def _time(f): return min(timeit.repeat(f, number=n, repeat=5))/n
+    results = {}
+    for name, f in fs.items():
+        t = _time(f)
+        with torch_only(): t_torch = _time(f)
+        results[name] = {'numpyify': t, 'torch_only': t_torch}
+    return results
+
+# Cell
+class _StageTimer: # Nested stages are emitted before the stage containing them
+    def __init__(self): self.times, self.args, self.stacks = {}, {}, {}
+
+    def __call__(self, event):
+        if event['ph'] != 'X': return
+        stack, t = self.stacks.setdefault(event['tid'], []), event['dur']
+        while len(stack) > 0 and stack[-1][0] >= event['ts']: t -= stack.pop()[1]
+        stack.append((event['ts'], event['dur']))
+        self.times[event['name']] = self.times.get(event['name'], 0) + t/1e6
+        self.args.setdefault(event['name'], []).append(event['args'])
+
+# Cell
+def _peak_rss(): # In MB
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+# Cell
+def _load_imgs(dir_imgs, lazy=False): # Camera and calibration board indices are parsed from file names
+    from .image import File16bitImg
+
+    imgs = []
+    for file_img in sorted(Path(dir_imgs).glob('*.png')):
+        img = File16bitImg(file_img, lazy=lazy)
+        img.idx_cam = int(re.search(r'_CAM_(\d+)_',   file_img.name).group(1))-1
+        img.idx_cb  = int(re.search(r'_COUNTER_(\d+)', file_img.name).group(1))-1
+        imgs.append(img)
+    return imgs
+
+# Cell
+def load_calib(file_calib): # Calibrations saved from notebooks reference classes in __main__
+    import __main__
+
+    import torch
+
+    from .calib import CamNode, CbNode, Obs
+
+    clss = {cls.__name__: cls for cls in (CamNode, CbNode, Obs) if not hasattr(__main__, cls.__name__)}
+    try:
+        for name, cls in clss.items(): setattr(__main__, name, cls)
+        return torch.load(file_calib)
+    finally:
+        for name in clss: delattr(__main__, name)
+
+# Cell
+def reprojection_rms(calib):
+    import torch
+
+    rs = torch.cat(calib['pss_c_p'])-torch.cat(calib['pss_c_p_m'])
+    rs = rs[torch.all(torch.isfinite(rs), dim=1)]
+    return torch.sqrt((rs**2).sum(dim=1).mean()).item()
+
+# Cell
+def compare_calibs(calib, calib_ref):
+    import torch
+
+    def _max_diff(As, Bs):
+        ds = [(A.detach().cpu()-B.detach().cpu()).abs() for A, B in zip(As, Bs)]
+        return max([d[torch.isfinite(d)].max().item() for d in ds if torch.isfinite(d).any()], default=0.0)
+
+    def _num_nan_diff(As, Bs): return sum(torch.sum(torch.isnan(A).any(dim=1) != torch.isnan(B).any(dim=1)).item() for A, B in zip(As, Bs))
+
+    idxs = {img.name: idx for idx, img in enumerate(calib['imgs'])}
+    idxs = [idxs[img.name] for img in calib_ref['imgs']]
+    pss_c_p, pss_c_p_m = [calib['pss_c_p'][idx] for idx in idxs], [calib['pss_c_p_m'][idx] for idx in idxs]
+    return {'cams':       _max_diff([cam.get_param() for cam in calib['cams']], [cam.get_param() for cam in calib_ref['cams']]),
+            'distorts':   _max_diff([getattr(distort, 'd', torch.zeros(0)) for distort in calib['distorts']],
+                                    [getattr(distort, 'd', torch.zeros(0)) for distort in calib_ref['distorts']]),
+            'rigids_cam': _max_diff([rigid.get_param() for rigid in calib['rigids_cam']], [rigid.get_param() for rigid in calib_ref['rigids_cam']]),
+            'rigids_cb':  _max_diff([rigid.get_param() for rigid in calib['rigids_cb']],  [rigid.get_param() for rigid in calib_ref['rigids_cb']]),
+            'pss_c_p':    _max_diff(pss_c_p,   calib_ref['pss_c_p']),
+            'pss_c_p_m':  _max_diff(pss_c_p_m, calib_ref['pss_c_p_m']),
+            'num_nan':    _num_nan_diff(pss_c_p, calib_ref['pss_c_p']),
+            'rms':        reprojection_rms(calib_ref)}
+
+# Cell
+def benchmark_calib(dir_imgs, file_model, file_ref=None, lazy=False, batch=False, sparse=False, file_trace=None, **kwargs):
+    from .calib import multi_calib
+    from .cb_geom import CbGeom, CpCSRGrid, FmCFPGrid
+    from .control_refine import OpenCVCheckerRefiner
+    from .fiducial_detect import DotVisionCheckerDLDetector
+
+    imgs = _load_imgs(dir_imgs, lazy)
+    cb_geom = CbGeom(50.8, 50.8, CpCSRGrid(16, 16, 2.032), FmCFPGrid(42.672, 42.672))
+    detector = DotVisionCheckerDLDetector(Path(file_model))
+    refiner = OpenCVCheckerRefiner(hw_min=5, hw_max=15, cutoff_it=20, cutoff_norm=1e-3, batch=batch, sparse=sparse)
+
+    timer = _StageTimer()
+    t = time.perf_counter()
+    with hook(timer), trace(file_trace), redirect_stdout(io.StringIO()):
+        calib = multi_calib(imgs, cb_geom, detector, refiner, **kwargs)
+    t = time.perf_counter()-t
+
+    *optims_single, optim = timer.args['optimize']
+    result = {'num_imgs': len(imgs),
+              'times':    {**timer.times, 'other': t-sum(timer.times.values()), 'total': t},
+              'rss_peak': _peak_rss(),
+              'its':      {'single': [optim_single['it'] for optim_single in optims_single], 'multi': optim['it']},
+              'rms':      reprojection_rms(calib)}
+    if file_ref is not None: result['ref'] = compare_calibs(calib, load_calib(file_ref))
+    return result
+
+# Cell
+def benchmark_detect(dir_imgs, file_model, lazy=False):
+    import torch
+
+    import camera_calib.calib
+    from .fiducial_detect import DotVisionCheckerDLDetector
+
+    imgs = _load_imgs(dir_imgs, lazy)
+    detector = DotVisionCheckerDLDetector(Path(file_model))
+
+    timer = _StageTimer()
+    t = time.perf_counter()
+    with hook(timer):
+        pss_f_p = camera_calib.calib.detect_imgs(detector, imgs, torch.double, torch.device('cpu'))
+    t = time.perf_counter()-t
+    return {'num_imgs':     len(imgs),
+            'num_detected': sum(torch.all(torch.isfinite(ps_f_p)).item() for ps_f_p in pss_f_p),
+            'times':        {**timer.times, 'other': t-sum(timer.times.values()), 'total': t},
+            'rss_peak':     _peak_rss()}
+
+# Cell
+def _run(name, *args, **kwargs):
+    code = f'import json; from camera_calib.benchmark import {name}; print(json.dumps({name}(*{args!r}, **{kwargs!r})))'
+    out = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(out.decode().splitlines()[-1])
+
+# Cell
+def _info():
+    import torch
+
+    import camera_calib
+
+    try:    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError): commit = None
+    return {'date':     datetime.now().isoformat(),
+            'commit':   commit,
+            'version':  camera_calib.__version__,
+            'python':   platform.python_version(),
+            'torch':    torch.__version__,
+            'platform': platform.platform(),
+            'num_cpu':  os.cpu_count()}
+
+# Cell
+def benchmark_suite(dir_data='data', file_model='models/dot_vision_checker.pth', file_json=None, lazy=False, batch=False, sparse=False, **kwargs):
+    dir_data = Path(dir_data)
+    results = {'info':               _info(),
+               'options':            {'lazy': lazy, 'batch': batch, 'sparse': sparse, **kwargs},
+               'dot_vision_checker': _run('benchmark_calib',
+                                          str(dir_data/'dot_vision_checker'),
+                                          str(file_model),
+                                          str(dir_data/'dot_vision_checker'/'calib.pth'),
+                                          lazy=lazy,
+                                          batch=batch,
+                                          sparse=sparse,
+                                          **kwargs),
+               'dot_vision_circle':  _run('benchmark_detect', str(dir_data/'dot_vision_circle'), str(file_model), lazy=lazy)}
+    if file_json is not None:
+        with open(file_json, 'w') as f: json.dump(results, f, indent=1)
+    return results
+
+# Cell
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the calibration pipeline on the bundled datasets')
+    parser.add_argument('file_json', nargs='?', help='output file; results are printed if not given')
+    parser.add_argument('--dir_data', default='data')
+    parser.add_argument('--file_model', default='models/dot_vision_checker.pth')
+    parser.add_argument('--lazy', action='store_true', help='use lazy 16 bit arrays')
+    parser.add_argument('--batch', action='store_true', help='use batched control point refinement')
+    parser.add_argument('--sparse', action='store_true', help='only compute image gradients around control points')
+    parser.add_argument('--optimizer', default='lbfgs')
+    parser.add_argument('--file_trace', help='Chrome trace of the checker calibration')
+    args = parser.parse_args()
+
+    results = benchmark_suite(args.dir_data, args.file_model, args.file_json, args.lazy, args.batch, args.sparse,
+                              optimizer=args.optimizer, file_trace=args.file_trace)
+    if args.file_json is None: print(json.dumps(results, indent=1))
\ No newline at end of file
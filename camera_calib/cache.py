@@ -0,0 +1,99 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: cache.ipynb (unless otherwise specified).
+
+__all__ = ['update_hash', 'hash_obj', 'hash_file', 'hash_img', 'DiskCache', 'cached']
+
+# Cell
+import hashlib
+import os
+import types
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from .image import FileImg
+from .utils import *
+
+# Cell
+def update_hash(h, obj):
+    if torch.is_tensor(obj): obj = torch2np(obj.detach().cpu())
+    if isinstance(obj, np.ndarray) and obj.dtype == object: obj = list(obj) # Hash contents, not pointers
+    if isinstance(obj, np.ndarray):
+        h.update(f'ndarray{obj.dtype}{obj.shape}'.encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (tuple, list)):
+        h.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for o in obj: update_hash(h, o)
+    elif isinstance(obj, dict):
+        h.update(f'dict{len(obj)}'.encode())
+        for key in sorted(obj, key=str): update_hash(h, (key, obj[key]))
+    elif isinstance(obj, torch.nn.Module):
+        update_hash(h, (type(obj).__name__, getattr(obj, 'code', None), dict(obj.state_dict())))
+    elif obj is None or isinstance(obj, (bool, int, float, str, torch.dtype, torch.device, Path)):
+        h.update(repr(obj).encode())
+    elif isinstance(obj, bytes):
+        h.update(f'bytes{len(obj)}'.encode())
+        h.update(obj)
+    elif isinstance(obj, type):
+        h.update(f'{obj.__module__}.{obj.__qualname__}'.encode())
+    elif isinstance(obj, types.FunctionType): # Lambdas and local functions can share a qualified name
+        update_hash(h, (f'{obj.__module__}.{obj.__qualname__}', obj.__code__, obj.__defaults__, obj.__kwdefaults__,
+                        [cell.cell_contents for cell in obj.__closure__ or ()]))
+    elif isinstance(obj, types.CodeType):
+        update_hash(h, (obj.co_code, obj.co_names, [c if isinstance(c, types.CodeType) else repr(c) for c in obj.co_consts]))
+    else: # Attributes which only change how results are computed (e.g. batching) are skipped
+        update_hash(h, (type(obj).__name__, {k: v for k, v in vars(obj).items() if k not in getattr(obj, 'attrs_exec', ())}))
+
+# Cell
+def hash_obj(*objs):
+    h = hashlib.sha256()
+    update_hash(h, objs)
+    return h.hexdigest()
+
+# Cell
+def hash_file(file, sz_chunk=2**20):
+    h = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(sz_chunk), b''): h.update(chunk)
+    return h.hexdigest()
+
+# Cell
+def hash_img(img): # File images are hashed by file content, which is faster than hashing the array
+    if isinstance(img, FileImg): return hash_obj(type(img).__name__, hash_file(img.file_img))
+    return hash_obj(type(img).__name__, img.array(torch.double))
+
+# Cell
+class DiskCache:
+    def __init__(self, dir_cache):
+        self.dir_cache = Path(dir_cache)
+        self.dir_cache.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def file(self, key): return self.dir_cache/f'{key}.pth'
+
+    def get(self, key):
+        file = self.file(key)
+        if not file.exists():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return torch.load(file)
+
+    def put(self, key, val):
+        file_tmp = self.dir_cache/f'{key}.{os.getpid()}.tmp'
+        torch.save(val, file_tmp)
+        file_tmp.replace(self.file(key))
+        return val
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.dir_cache}, hits={self.hits}, misses={self.misses})'
+
+# Cell
+def cached(cache, keys, f, *args):
+    vals = [None]*len(args[0]) if cache is None else [cache.get(key) for key in keys]
+    idxs = [idx for idx, val in enumerate(vals) if val is None]
+    if len(idxs) > 0:
+        for idx, val in f(*[[arg[idx] for idx in idxs] for arg in args]): # Store values as soon as they're yielded
+            vals[idxs[idx]] = val if cache is None else cache.put(keys[idxs[idx]], val)
+    return vals
\ No newline at end of file
@@ -1,17 +1,25 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: calib.ipynb (unless otherwise specified).
 
-__all__ = ['init_intrin', 'init_extrin', 'SSE', 'w2p_loss', 'lbfgs_optimize', 'Node', 'CamNode', 'CbNode',
-           'plot_bipartite', 'single_calib', 'multi_calib']
+__all__ = ['init_intrin', 'init_intrin_batch', 'init_extrin', 'init_extrin_batch', 'Obs', 'SSE', 'w2p_loss', 'rig_loss',
+           'print_progress', 'lbfgs_optimize', 'lm_optimize', 'rig_optimize', 'Node', 'CamNode', 'CbNode',
+           'plot_bipartite', 'detect_imgs', 'iter_detect_imgs', 'iter_refine_imgs', 'refine_imgs', 'single_calib',
+           'calib_cams', 'multi_calib']
 
 # Cell
-import matplotlib.pyplot as plt
-import networkx as nx
+import math
+import multiprocessing as mp
+import time
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+
 import numpy as np
 import torch
 
+from .cache import cached, hash_img, hash_obj
 from .control_refine import CheckerRefiner
+from .hooks import counter, hooked, replay, stage, trace
 from .modules import (CamSF, Heikkila97Distortion, Inverse,
-                                  Normalize, Rigid)
+                                  Rig, Rigid)
 from .utils import *
 
 # Cell
@@ -37,6 +45,25 @@ def init_intrin(Hs, sz):
                      ( zero, alpha,  yo),
                      ( zero,  zero, one)))
 
+# Cell
+@numpyify
+def init_intrin_batch(Hs, sz):
+    zero, one = Hs.new_tensor(0), Hs.new_tensor(1)
+
+    yo, xo = (sz-1)/2
+    po_inv = stackify((( one, zero, -xo),
+                       (zero,  one, -yo),
+                       (zero, zero, one)))
+    Hs_bar = po_inv@Hs
+    v1s, v2s = Hs_bar[:, :, 0], Hs_bar[:, :, 1]
+    v1s, v2s, v3s, v4s = unitize(torch.cat([v1s, v2s, v1s+v2s, v1s-v2s])).split(len(Hs))
+    A = stackify((v1s[:, 0]*v2s[:, 0]+v1s[:, 1]*v2s[:, 1], v3s[:, 0]*v4s[:, 0]+v3s[:, 1]*v4s[:, 1]), dim=1).reshape(-1)
+    b = stackify((-v1s[:, 2]*v2s[:, 2], -v3s[:, 2]*v4s[:, 2]), dim=1).reshape(-1)
+    alpha = torch.sqrt(torch.dot(b,A)/torch.dot(b,b))
+    return stackify(((alpha,  zero,  xo),
+                     ( zero, alpha,  yo),
+                     ( zero,  zero, one)))
+
 # Cell
 @numpyify
 def init_extrin(H, A):
@@ -48,34 +75,252 @@ def init_extrin(H, A):
     t = H_bar[:,2]/lambdas[0:2].mean()
     return R, t
 
+# Cell
+@numpyify
+def init_extrin_batch(Hs, A):
+    Hs_bar = torch.inverse(A)@Hs
+    lambdas = torch.norm(Hs_bar, dim=1)
+    r1s, r2s = Hs_bar[:, :, 0]/lambdas[:, 0:1], Hs_bar[:, :, 1]/lambdas[:, 1:2]
+    r3s = torch.cross(r1s, r2s, dim=1)
+    Rs = approx_R_batch(stackify((r1s, r2s, r3s), dim=2))
+    ts = Hs_bar[:, :, 2]/lambdas[:, 0:2].mean(dim=1, keepdim=True)
+    return Rs, ts
+
+# Cell
+class Obs:
+    def __init__(self, pss_c_p, idxs_cam=None, idxs_cb=None):
+        pss_c_p = stackify(tuple(pss_c_p))
+        if idxs_cam is None: idxs_cam = torch.zeros(len(pss_c_p), dtype=torch.long, device=pss_c_p.device)
+        if idxs_cb  is None: idxs_cb  = torch.arange(len(pss_c_p), device=pss_c_p.device)
+
+        self.mask = torch.all(torch.isfinite(pss_c_p), dim=2)
+        self.idxs_img, self.idxs_c = self.mask.nonzero(as_tuple=True)
+        self.idxs_cam, self.idxs_cb = idxs_cam[self.idxs_img], idxs_cb[self.idxs_img]
+        self.ps_c_p = pss_c_p[self.mask]
+        self.counts = self.mask.sum(dim=1).tolist()
+
+    def __len__(self): return len(self.ps_c_p)
+
+    def pack(self, pss): return pss[self.idxs_img, self.idxs_c] # Per image points => packed points
+
+    def unpack(self, ps=None, val=math.nan):                    # Packed points => per image points
+        if ps is None: ps = self.ps_c_p
+        pss = ps.new_full((*self.mask.shape, *ps.shape[1:]), val)
+        pss[self.mask] = ps
+        return pss
+
+    def split(self, ps=None):                                   # Packed points => tuple of points for each image
+        if ps is None: ps = self.ps_c_p
+        return ps.split(self.counts)
+
 # Cell
 def SSE(x1, x2): return ((x1-x2)**2).sum()
 
 # Cell
-def w2p_loss(w2ps, ps_c_w, pss_c_p, loss):
+def w2p_loss(w2ps, ps_c_w, obs, loss):
     ls = []
-    for w2p, ps_c_p in zip(w2ps, pss_c_p):
-        idx = torch.all(torch.isfinite(ps_c_p), dim=1)
-        ls.append(loss(w2p(ps_c_w[idx]), ps_c_p[idx]))
+    for w2p, idxs_c, ps_c_p in zip(w2ps, obs.split(obs.idxs_c), obs.split()):
+        ls.append(loss(w2p(ps_c_w[idxs_c]), ps_c_p))
     return sum(ls)
 
 # Cell
-def lbfgs_optimize(f_get_params, f_get_loss, cutoff_it, cutoff_norm):
-    def _cat_params(): return torch.cat([p.view(-1) for p in f_get_params()])
-    optim = torch.optim.LBFGS(f_get_params())
-    params_prev = _cat_params()
-    for it in torch.arange(cutoff_it):
+def rig_loss(rig, ps_c_w, obs, loss): return loss(obs.pack(rig(ps_c_w)), obs.ps_c_p)
+
+# Cell
+def print_progress(it, loss, norm, **kwargs): print(f' - Iteration: {it:03d} - Norm: {norm:10.5f} - Loss: {loss:10.5f}')
+
+# Cell
+def _report(info, l_prev, callback, cutoff_norm, cutoff_loss, cutoff_grad, cutoff_time):
+    counter('loss', loss=info['loss'])
+    counter('norm', norm=info['norm'])
+    if callback is not None: callback(**info)
+
+    # Returns the convergence criterion which is met, if any
+    if info['norm'] < cutoff_norm:                                                                 return 'norm'
+    if cutoff_loss is not None and l_prev is not None and abs(l_prev-info['loss']) < cutoff_loss: return 'loss'
+    if cutoff_grad is not None and info['grad'] < cutoff_grad:                                    return 'grad'
+    if cutoff_time is not None and info['time'] > cutoff_time:                                    return 'time'
+
+# Cell
+def lbfgs_optimize(f_get_params,
+                   f_get_loss,
+                   cutoff_it,
+                   cutoff_norm,
+                   cutoff_loss=None,
+                   cutoff_grad=None,
+                   cutoff_time=None,
+                   callback=print_progress):
+    time_start = time.perf_counter()
+    params = f_get_params()
+    optim = torch.optim.LBFGS(params)
+    params_prev = [p.detach().clone() for p in params]
+    it, l_prev, stop = -1, None, None # Iteration count is zero if cutoff_it is zero
+    for it in range(cutoff_it):
         def _closure():
             optim.zero_grad()
             l = f_get_loss()
             l.backward()
             return l
         optim.step(_closure)
-        params = _cat_params()
-        norm = torch.norm(params-params_prev)
-        print(f' - Iteration: {it:03d} - Norm: {norm.item():10.5f} - Loss: {f_get_loss().item():10.5f}')
-        if norm < cutoff_norm: break
-        params_prev = params
+
+        # The step can update parameters after its last evaluation (i.e. when it hits its inner max_iter), so
+        # evaluate the loss at the updated parameters. The gradient is only reevaluated if it's a cutoff.
+        if cutoff_grad is None:
+            with torch.no_grad(): l = f_get_loss()
+        else: l = _closure()
+        info = {'it':   it,
+                'loss': l.item(),
+                'norm': torch.norm(stackify(tuple(torch.norm(p.detach()-p_prev) for p, p_prev in zip(params, params_prev)))).item(),
+                'grad': torch.norm(stackify(tuple(torch.norm(p.grad) for p in params if p.grad is not None))).item(),
+                'time': time.perf_counter()-time_start}
+        for p, p_prev in zip(params, params_prev): p_prev.copy_(p.detach())
+        stop = _report(info, l_prev, callback, cutoff_norm, cutoff_loss, cutoff_grad, cutoff_time)
+        if stop is not None: break
+        l_prev = info['loss']
+    return {'it': it+1, 'time': time.perf_counter()-time_start, 'stop': stop or 'it'}
+
+# Cell
+def lm_optimize(rig,
+                ps_c_w,
+                obs,
+                cutoff_it,
+                cutoff_norm,
+                lambda_init=1e-3,
+                jacobian='analytic',
+                cutoff_loss=None,
+                cutoff_grad=None,
+                cutoff_time=None,
+                callback=print_progress):
+    time_start = time.perf_counter()
+
+    # Residuals are formed per image; missing control points are masked
+    mask, pss_c_p = obs.mask[:, :, None], obs.unpack(val=0)
+
+    # Parameters are grouped into camera and calibration board blocks
+    names_cam = [name for name in ['a', 'd', 'euler_cam', 't_cam'] if getattr(rig, name) is not None]
+    names_cb  = ['euler_cb', 't_cb']
+    szs_cam = [getattr(rig, name).shape[1] for name in names_cam]
+    szs_cb  = [getattr(rig, name).shape[1] for name in names_cb]
+    xs_cam = torch.cat([getattr(rig, name).detach() for name in names_cam], dim=1)
+    xs_cb  = torch.cat([getattr(rig, name).detach() for name in names_cb],  dim=1)
+    (num_cam, sz_cam), (num_cb, sz_cb) = xs_cam.shape, xs_cb.shape
+    idxs_cam, idxs_cb = rig.idxs_cam, rig.idxs_cb
+    mask_fixed = torch.zeros_like(xs_cam, dtype=torch.bool)
+    if rig.euler_cam is not None: mask_fixed[rig.fixed_cam, -6:] = True
+
+    def _get_params(xs_cam_img, xs_cb_img):
+        return {**dict(zip(names_cam, xs_cam_img.split(szs_cam, dim=1))),
+                **dict(zip(names_cb,  xs_cb_img.split(szs_cb,   dim=1)))}
+
+    def _get_rs(xs_cam_img, xs_cb_img):
+        pss = rig.forward_img(ps_c_w, **_get_params(xs_cam_img, xs_cb_img))
+        return ((pss-pss_c_p)*mask).reshape(len(xs_cam_img), -1)
+
+    def _get_rs_Js(xs_cam, xs_cb):
+        if jacobian == 'analytic':
+            pss, Js = rig.jacobian_img(ps_c_w, **_get_params(xs_cam[idxs_cam], xs_cb[idxs_cb]))
+            rs = ((pss-pss_c_p)*mask).reshape(len(pss), -1)
+            Js_cam = (torch.cat([Js[name] for name in names_cam], dim=3)*mask[:, :, :, None]).reshape(len(pss), -1, sz_cam)
+            Js_cb  = (torch.cat([Js[name] for name in names_cb],  dim=3)*mask[:, :, :, None]).reshape(len(pss), -1, sz_cb)
+            return rs, Js_cam, Js_cb
+        elif jacobian != 'autograd':
+            raise RuntimeError(f'Unrecognized option: {jacobian}')
+
+        xs_cam_img = xs_cam[idxs_cam].requires_grad_()
+        xs_cb_img  = xs_cb[idxs_cb].requires_grad_()
+        rs = _get_rs(xs_cam_img, xs_cb_img)
+
+        # Jacobian-vector products via the "double backward" trick; columns of each image are computed together
+        us = torch.zeros_like(rs, requires_grad=True)
+        gs = torch.autograd.grad(rs, [xs_cam_img, xs_cb_img], us, create_graph=True)
+        Js = []
+        for g in gs:
+            J = []
+            for idx in range(g.shape[1]):
+                v = torch.zeros_like(g)
+                v[:, idx] = 1
+                J.append(torch.autograd.grad(g, us, v, retain_graph=True)[0])
+            Js.append(stackify(tuple(J), dim=2))
+        return (rs.detach(), *Js)
+
+    def _get_gs(rs, Js_cam, Js_cb): # Half the gradient of the loss
+        gs_cam = xs_cam.new_zeros(num_cam, sz_cam).index_add_(0, idxs_cam, (Js_cam.transpose(1, 2)@rs[:, :, None])[:, :, 0])
+        gs_cb  = xs_cb.new_zeros(num_cb, sz_cb).index_add_(0, idxs_cb,  (Js_cb.transpose(1, 2)@rs[:, :, None])[:, :, 0])
+        return gs_cam.masked_fill(mask_fixed, 0), gs_cb
+
+    lambda_ = lambda_init
+    rs, Js_cam, Js_cb = _get_rs_Js(xs_cam, xs_cb)
+    l, (gs_cam, gs_cb) = (rs**2).sum(), _get_gs(rs, Js_cam, Js_cb)
+    it, l_prev, stop = -1, None, None # Iteration count is zero if cutoff_it is zero
+    for it in range(cutoff_it):
+        # Form normal equations from jacobian blocks
+        U = xs_cam.new_zeros(num_cam, sz_cam, sz_cam).index_add_(0, idxs_cam, Js_cam.transpose(1, 2)@Js_cam)
+        V = xs_cb.new_zeros(num_cb, sz_cb, sz_cb).index_add_(0, idxs_cb, Js_cb.transpose(1, 2)@Js_cb)
+        W = xs_cam.new_zeros(num_cam, num_cb, sz_cam, sz_cb).index_put_((idxs_cam, idxs_cb),
+                                                                         Js_cam.transpose(1, 2)@Js_cb,
+                                                                         accumulate=True)
+
+        # Remove fixed parameters
+        U = U.masked_fill(mask_fixed[:, :, None] | mask_fixed[:, None, :], 0)
+        U = U + torch.diag_embed(mask_fixed.to(U.dtype))
+        W = W.masked_fill(mask_fixed[:, None, :, None], 0)
+
+        # Try steps until loss decreases
+        while True:
+            U_d = U + lambda_*torch.diag_embed(torch.diagonal(U, dim1=1, dim2=2))
+            V_d = V + lambda_*torch.diag_embed(torch.diagonal(V, dim1=1, dim2=2))
+            V_d_inv = torch.inverse(V_d)
+
+            # Schur complement
+            WV_inv = W@V_d_inv
+            S = -torch.einsum('cbij,dbkj->cidk', WV_inv, W)
+            S[torch.arange(num_cam), :, torch.arange(num_cam)] += U_d
+            S = S.reshape(num_cam*sz_cam, num_cam*sz_cam)
+            b = -gs_cam + torch.einsum('cbij,bj->ci', WV_inv, gs_cb)
+            dxs_cam = (torch.inverse(S)@b.reshape(-1, 1)).reshape(num_cam, sz_cam)
+            dxs_cb  = (V_d_inv@(-gs_cb - torch.einsum('cbij,ci->bj', W, dxs_cam))[:, :, None])[:, :, 0]
+
+            with torch.no_grad(): l_new = (_get_rs((xs_cam+dxs_cam)[idxs_cam], (xs_cb+dxs_cb)[idxs_cb])**2).sum()
+            if torch.isfinite(l_new) and l_new < l: lambda_ /= 10; break
+            lambda_ *= 10
+            if lambda_ > 1e16: break
+        if lambda_ > 1e16: stop = 'lambda'; break # Loss cannot be decreased anymore
+
+        # Update parameters
+        xs_cam, xs_cb = xs_cam+dxs_cam, xs_cb+dxs_cb
+        rs, Js_cam, Js_cb = _get_rs_Js(xs_cam, xs_cb)
+        l, (gs_cam, gs_cb) = (rs**2).sum(), _get_gs(rs, Js_cam, Js_cb)
+        info = {'it':   it,
+                'loss': l.item(),
+                'norm': torch.norm(torch.cat([dxs_cam.flatten(), dxs_cb.flatten()])).item(),
+                'grad': 2*torch.norm(torch.cat([gs_cam.flatten(), gs_cb.flatten()])).item(),
+                'time': time.perf_counter()-time_start}
+        stop = _report(info, l_prev, callback, cutoff_norm, cutoff_loss, cutoff_grad, cutoff_time)
+        if stop is not None: break
+        l_prev = info['loss']
+
+    # Copy parameters back into rig
+    with torch.no_grad():
+        for name, x in zip(names_cam + names_cb, xs_cam.split(szs_cam, dim=1) + xs_cb.split(szs_cb, dim=1)):
+            getattr(rig, name).copy_(x)
+    return {'it': it+1, 'time': time.perf_counter()-time_start, 'stop': stop or 'it'}
+
+# Cell
+def rig_optimize(rig, ps_c_w, obs, loss, optimizer, cutoff_it, cutoff_norm, **kwargs):
+    with stage('optimize', optimizer=optimizer) as args:
+        if optimizer == 'lbfgs':
+            optim = lbfgs_optimize(lambda: list(rig.parameters()),
+                                   lambda: rig_loss(rig, ps_c_w, obs, loss),
+                                   cutoff_it,
+                                   cutoff_norm,
+                                   **kwargs)
+        elif optimizer == 'lm':
+            if loss is not SSE: raise RuntimeError(f'Dont know how to handle: {loss}')
+            optim = lm_optimize(rig, ps_c_w, obs, cutoff_it, cutoff_norm, **kwargs)
+        else:
+            raise RuntimeError(f'Unrecognized option: {optimizer}')
+        args.update(optim)
+    return optim
 
 # Cell
 class Node:
@@ -98,6 +343,9 @@ class CbNode(Node):
 
 # Cell
 def plot_bipartite(G, nodes1, nodes2, ax=None):
+    import matplotlib.pyplot as plt
+    import networkx as nx
+
     if ax == None: _, ax = plt.subplots(1, 1, figsize=(10,10))
 
     def _get_p(nodes, x): return {node: (x,y) for node,y in zip(nodes, torch.linspace(0, 1, len(nodes)))}
@@ -111,6 +359,54 @@ def plot_bipartite(G, nodes1, nodes2, ax=None):
     ax.set_ylim(-0.5, 1.5)
     ax.invert_yaxis()
 
+# Cell
+def _iter_completed(futures): # Yields (index, result) as futures finish; the first error is raised after all other results
+    idxs, error = {future: idx for idx, future in enumerate(futures)}, None
+    for future in as_completed(idxs):
+        if future.exception() is None: yield idxs[future], future.result()
+        elif error is None:            error = future.exception()
+    if error is not None: raise error
+
+# Cell
+def detect_imgs(detector, imgs, dtype, device): # Use batched, reduced resolution images if detector supports it
+    if hasattr(detector, 'detect_imgs'):
+        with stage('detect', imgs=[img.name for img in imgs]): return detector.detect_imgs(imgs, dtype, device)
+
+    pss_f_p = []
+    for img in imgs:
+        with stage('detect', img=img.name): pss_f_p.append(detector(img.array_gs(dtype, device)))
+    return pss_f_p
+
+# Cell
+def iter_detect_imgs(detector, imgs, dtype, device): # Yields (index, points) as batches of images finish
+    sz_batch = getattr(detector, 'batch_size', max(len(imgs), 1)) if hasattr(detector, 'detect_imgs') else 1
+    for idx in range(0, len(imgs), sz_batch):
+        yield from enumerate(detect_imgs(detector, imgs[idx:idx+sz_batch], dtype, device), idx)
+
+# Cell
+def iter_refine_imgs(refiner, imgs, Hs, cb_geom, dtype, device, num_threads=1): # Yields (index, points) as images finish
+    ps_c_w = cb_geom.ps_c(dtype, device)
+    bs_c_w = cb_geom.bs_c(dtype, device)
+
+    def _refine_img(img, H):
+        print(f'Refining control points for: {img.name}...')
+        with stage('refine', img=img.name):
+            ps_c_p = pmm(ps_c_w, H, aug=True) # This guess should be updated for circle control points
+            bs_c_p = [pmm(b_c_w, H, aug=True) for b_c_w in bs_c_w]
+            return refiner(img.array_gs(dtype, device), ps_c_p, bs_c_p)
+
+    if num_threads > 1: # Refiners are stateless, so one refiner can refine images in separate threads
+        with ThreadPoolExecutor(num_threads) as executor:
+            yield from _iter_completed([executor.submit(_refine_img, img, H) for img, H in zip(imgs, Hs)])
+    else:
+        for idx, (img, H) in enumerate(zip(imgs, Hs)): yield idx, _refine_img(img, H)
+
+# Cell
+def refine_imgs(refiner, imgs, Hs, cb_geom, dtype, device, num_threads=1):
+    pss_c_p = [None]*len(imgs)
+    for idx, ps_c_p in iter_refine_imgs(refiner, imgs, Hs, cb_geom, dtype, device, num_threads): pss_c_p[idx] = ps_c_p
+    return pss_c_p
+
 # Cell
 def single_calib(imgs,
                  cb_geom,
@@ -121,8 +417,11 @@ def single_calib(imgs,
                  loss=SSE,
                  cutoff_it=500,
                  cutoff_norm=1e-6,
+                 optimizer='lbfgs',
                  dtype=torch.double,
-                 device=torch.device('cpu')):
+                 device=torch.device('cpu'),
+                 cache=None,
+                 num_threads=1):
     if Distortion is None:
         Distortion = lambda:Heikkila97Distortion(torch.zeros(4, dtype=dtype, device=device))
 
@@ -131,23 +430,26 @@ def single_calib(imgs,
     ps_c_w = cb_geom.ps_c(dtype, device)
     bs_c_w = cb_geom.bs_c(dtype, device)
 
+    # Get cache keys; fiducial points depend on image and detector, control points also depend on refiner and cb_geom
+    keys_f, keys_c = None, None
+    if cache is not None:
+        keys_f = [hash_obj('ps_f_p', hash_img(img), detector, dtype) for img in imgs]
+        keys_c = [hash_obj('ps_c_p', key_f, refiner, ps_f_w, ps_c_w, bs_c_w) for key_f in keys_f]
+
     # Get initial homographies via fiducial markers
-    Hs = [homography(ps_f_w, detector(img.array_gs(dtype, device))) for img in imgs]
+    pss_f_p = cached(cache, keys_f, lambda imgs: iter_detect_imgs(detector, imgs, dtype, device), imgs)
+    with stage('init'): Hs = homography_batch(ps_f_w.expand(len(pss_f_p), -1, -1), stackify(tuple(pss_f_p)))
 
     # Refine control points
-    pss_c_p = []
-    for img, H in zip(imgs, Hs):
-        print(f'Refining control points for: {img.name}...')
-        ps_c_p = pmm(ps_c_w, H, aug=True) # This guess should be updated for circle control points
-        bs_c_p = [pmm(b_c_w, H, aug=True) for b_c_w in bs_c_w]
-        pss_c_p.append(refiner(img.array_gs(dtype, device), ps_c_p, bs_c_p))
+    pss_c_p = cached(cache, keys_c, lambda imgs, Hs: iter_refine_imgs(refiner, imgs, Hs, cb_geom, dtype, device, num_threads), imgs, Hs)
 
-    # Update homographies with refined control points; should be updated for circle control points
-    Hs = [homography(ps_c_w, ps_c_p) for ps_c_p in pss_c_p]
+    with stage('init'):
+        # Update homographies with refined control points; should be updated for circle control points
+        Hs = homography_batch(ps_c_w.expand(len(pss_c_p), -1, -1), stackify(tuple(pss_c_p)))
 
-    # Get initial guesses; distortion assumed to be zero
-    A = init_intrin(Hs, torch.tensor(imgs[0].size, dtype=dtype, device=device))
-    Rs, ts = zip(*[init_extrin(H, A) for H in Hs])
+        # Get initial guesses; distortion assumed to be zero
+        A = init_intrin_batch(Hs, torch.tensor(imgs[0].size, dtype=dtype, device=device))
+        Rs, ts = init_extrin_batch(Hs, A)
 
     # Format control points
     ps_c_w = torch.cat((ps_c_w, ps_c_w.new_zeros(len(ps_c_w),1)), dim=1) # 3rd dimension is zero
@@ -157,16 +459,15 @@ def single_calib(imgs,
     distort = Distortion()
     rigids = [Rigid(R,t) for R,t in zip(Rs,ts)]
     if isinstance(refiner, CheckerRefiner):
-        w2ps = [torch.nn.Sequential(rigid, Normalize(), distort, cam) for rigid in rigids]
+        rig = Rig([cam], [distort], rigids, torch.arange(len(rigids), device=device))
     else:
         raise RuntimeError(f'Dont know how to handle: {type(refiner)}')
 
     # Optimize parameters
     print(f'Refining single parameters...')
-    lbfgs_optimize(lambda: sum([list(m.parameters()) for m in [cam, distort]+rigids], []),
-                   lambda: w2p_loss(w2ps, ps_c_w, pss_c_p, loss),
-                   cutoff_it,
-                   cutoff_norm)
+    obs = Obs(pss_c_p, rig.idxs_cam, rig.idxs_cb)
+    optim = rig_optimize(rig, ps_c_w, obs, loss, optimizer, cutoff_it, cutoff_norm)
+    rig.update_modules()
 
     return {'imgs': imgs,
             'cb_geom': cb_geom,
@@ -174,10 +475,44 @@ def single_calib(imgs,
             'distort': distort,
             'rigids': rigids,
             'pss_c_p': pss_c_p,
-            'pss_c_p_m': [w2p(ps_c_w).detach() for w2p in w2ps],
+            'pss_c_p_m': list(rig(ps_c_w).detach()),
+            'obs': obs,
+            'optim': optim,
             'dtype': dtype,
             'device': device}
 
+# Cell
+def _calib_cam(imgs_cam, args, num_threads): # Only keep what multi_calib uses, so workers dont send back images
+    calib = single_calib(imgs_cam, *args, num_threads)
+    return {key: calib[key] for key in ('cam', 'distort', 'rigids', 'pss_c_p')}
+
+# Cell
+def _calib_cam_worker(imgs_cam, args, num_threads, traced): # Hook events and cache counts are sent back to the parent
+    cache = args[-1]
+    counts = (0, 0) if cache is None else (cache.hits, cache.misses)
+    if traced:
+        with trace() as tracer: calib = _calib_cam(imgs_cam, args, num_threads)
+    else:
+        calib = _calib_cam(imgs_cam, args, num_threads)
+    if cache is not None: counts = (cache.hits-counts[0], cache.misses-counts[1])
+    return calib, tracer.events if traced else [], counts
+
+# Cell
+def calib_cams(imgss_cam, args, num_workers, num_threads): # Yields (index, calibration) as cameras finish
+    if num_workers > 1: # Cameras are independent; calibrate them in separate processes
+        cache = args[-1]
+        with ProcessPoolExecutor(num_workers,
+                                 mp_context=mp.get_context('spawn'),
+                                 initializer=torch.set_num_threads,
+                                 initargs=(1,)) as executor:
+            futures = [executor.submit(_calib_cam_worker, imgs_cam, args, num_threads, hooked()) for imgs_cam in imgss_cam]
+            for idx, (calib, events, (hits, misses)) in _iter_completed(futures):
+                replay(events)
+                if cache is not None: cache.hits, cache.misses = cache.hits+hits, cache.misses+misses
+                yield idx, calib
+    else:
+        for idx, imgs_cam in enumerate(imgss_cam): yield idx, _calib_cam(imgs_cam, args, num_threads)
+
 # Cell
 def multi_calib(imgs,
                 cb_geom,
@@ -188,10 +523,13 @@ def multi_calib(imgs,
                 loss=SSE,
                 cutoff_it=500,
                 cutoff_norm=1e-6,
+                optimizer='lbfgs',
                 dtype=torch.double,
-                device=torch.device('cpu')):
-    if Distortion is None:
-        Distortion = lambda:Heikkila97Distortion(torch.zeros(4, dtype=dtype, device=device))
+                device=torch.device('cpu'),
+                cache=None,
+                num_workers=1,
+                num_threads=1):
+    import networkx as nx
 
     # Get calibration board world coordinates
     ps_c_w = cb_geom.ps_c(dtype, device)
@@ -206,20 +544,16 @@ def multi_calib(imgs,
     G = nx.DiGraph()
     nodes_cb  = [CbNode(idx_cb) for idx_cb in idxs_cb]
     nodes_cam = []
-    for idx_cam in idxs_cam:
-        imgs_cam = [img for img in imgs if img.idx_cam == idx_cam]
-        calib = single_calib(imgs_cam,
-                             cb_geom,
-                             detector,
-                             refiner,
-                             Cam,
-                             Distortion,
-                             loss,
-                             cutoff_it,
-                             cutoff_norm,
-                             dtype,
-                             device)
-        for img_cam, ps_c_p in zip(imgs_cam, calib['pss_c_p']): img_cam.ps_c_p = ps_c_p
+    idxss_img = [[idx for idx, img in enumerate(imgs) if img.idx_cam == idx_cam] for idx_cam in idxs_cam]
+    imgss_cam = [[imgs[idx] for idx in idxs_img] for idxs_img in idxss_img]
+    args = (cb_geom, detector, refiner, Cam, Distortion, loss, cutoff_it, cutoff_norm, optimizer, dtype, device, cache)
+    keys_cam = None
+    if cache is not None:
+        keys_cam = [hash_obj('single_calib', [hash_img(img) for img in imgs_cam], args[:-1]) for imgs_cam in imgss_cam]
+    calibs = cached(cache, keys_cam, lambda imgss_cam: calib_cams(imgss_cam, args, num_workers, num_threads), imgss_cam)
+    pss_c_p = [None]*len(imgs)
+    for idx_cam, idxs_img, imgs_cam, calib in zip(idxs_cam, idxss_img, imgss_cam, calibs):
+        for idx, ps_c_p in zip(idxs_img, calib['pss_c_p']): pss_c_p[idx] = ps_c_p
         node_cam = CamNode(idx_cam, calib['cam'], calib['distort'])
         for img_cam, rigid in zip(imgs_cam, calib['rigids']):
             node_cb = nodes_cb[img_cam.idx_cb]
@@ -234,29 +568,37 @@ def multi_calib(imgs,
 
     # Format control points
     ps_c_w = torch.cat((ps_c_w, ps_c_w.new_zeros(len(ps_c_w),1)), dim=1) # 3rd dimension is zero
-    pss_c_p = [img.ps_c_p for img in imgs]
 
     # Initialize modules
     cams = [node_cam.cam for node_cam in nodes_cam]
     distorts = [node_cam.distort for node_cam in nodes_cam]
     rigids_cb  = [Rigid(*M2Rt(node_cb.M))  for node_cb  in nodes_cb]
     rigids_cam = [Rigid(*M2Rt(node_cam.M)) for node_cam in nodes_cam]
+    for p in rigids_cam[0].parameters(): p.requires_grad_(False) # First rigid camera transform is identity
     if isinstance(refiner, CheckerRefiner):
-        w2ps = [torch.nn.Sequential(rigids_cb[img.idx_cb],
-                                    Inverse(rigids_cam[img.idx_cam]),
-                                    Normalize(),
-                                    distorts[img.idx_cam],
-                                    cams[img.idx_cam]) for img in imgs]
+        rig = Rig(cams,
+                  distorts,
+                  rigids_cb,
+                  torch.tensor([img.idx_cb for img in imgs], device=device),
+                  rigids_cam,
+                  torch.tensor([img.idx_cam for img in imgs], device=device))
     else:
         raise RuntimeError(f'Dont know how to handle: {type(refiner)}')
 
-    # Optimize parameters; make sure not to optimize first rigid camera transform (which is identity)
-    print(f'Refining multi parameters...')
-    for p in rigids_cam[0].parameters(): p.requires_grad_(False)
-    lbfgs_optimize(lambda: sum([list(m.parameters()) for m in cams+distorts+rigids_cb+rigids_cam[1:]], []),
-                   lambda: w2p_loss(w2ps, ps_c_w, pss_c_p, loss),
-                   cutoff_it,
-                   cutoff_norm)
+    # Optimize parameters; first rigid camera transform is fixed by the rig
+    obs = Obs(pss_c_p, rig.idxs_cam, rig.idxs_cb)
+    key_rig = None
+    if cache is not None:
+        key_rig = hash_obj('multi_calib', keys_cam, [(img.idx_cam, img.idx_cb) for img in imgs], args[5:-1])
+    state = None if cache is None else cache.get(key_rig)
+    if state is None:
+        print(f'Refining multi parameters...')
+        optim = rig_optimize(rig, ps_c_w, obs, loss, optimizer, cutoff_it, cutoff_norm)
+        state = {'rig': rig.state_dict(), 'optim': optim}
+        if cache is not None: cache.put(key_rig, state)
+    rig.load_state_dict(state['rig'])
+    rig.update_modules()
+    optim = state['optim']
 
     return {'imgs': imgs,
             'cb_geom': cb_geom,
@@ -265,7 +607,9 @@ def multi_calib(imgs,
             'rigids_cb': rigids_cb,
             'rigids_cam': rigids_cam,
             'pss_c_p': pss_c_p,
-            'pss_c_p_m': [w2p(ps_c_w).detach() for w2p in w2ps],
+            'pss_c_p_m': list(rig(ps_c_w).detach()),
+            'obs': obs,
             'graph': (G, nodes_cam, nodes_cb),
+            'optim': optim,
             'dtype': dtype,
             'device': device}
\ No newline at end of file
@@ -3,7 +3,6 @@
 __all__ = ['PGeom', 'BGeom', 'CpGeom', 'CpCSRGrid', 'CpCSDGrid', 'FmGeom', 'FmCFPGrid', 'CbGeom']
 
 # Cell
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 
@@ -74,6 +73,8 @@ class CbGeom():
     def ps_f(self, dtype, device=None): return delete(self.fm_geom.ps(dtype, device), self.idx_f_exclude)
 
     def plot(self, ax=None):
+        import matplotlib.pyplot as plt
+
         if ax is None:
             plt.figure(figsize=(10,10))
             ax = plt.gca()
@@ -1,13 +1,14 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: control_refine.ipynb (unless otherwise specified).
 
-__all__ = ['CPRefiner', 'CheckerRefiner', 'checker_opencv', 'OpenCVCheckerRefiner', 'EllipseRefiner', 'fit_conic',
-           'ellipse_dualconic', 'DualConicEllipseRefiner']
+__all__ = ['CPRefiner', 'CheckerRefiner', 'checker_opencv', 'checker_opencv_batch', 'OpenCVCheckerRefiner',
+           'EllipseRefiner', 'fit_conic', 'ellipse_dualconic', 'fit_conic_batch', 'ellipse_dualconic_batch',
+           'DualConicEllipseRefiner']
 
 # Cell
+import functools
 import math
 
 import numpy as np
-import skimage.draw
 import torch
 from torch.distributions.multivariate_normal import MultivariateNormal
 
@@ -15,40 +16,126 @@ from .utils import *
 
 # Cell
 class CPRefiner:
-    def __init__(self, cutoff_it, cutoff_norm):
+    hw_proc = 0                      # Number of neighboring pixels proc_arr needs to process a pixel
+    attrs_exec = ('batch', 'sparse') # Only change how points are refined, not the result, so not part of cache keys
+
+    def __init__(self, cutoff_it, cutoff_norm, batch=False, sparse=False):
         self.cutoff_it   = cutoff_it
         self.cutoff_norm = cutoff_norm
+        self.batch       = batch
+        self.sparse      = sparse
 
     def proc_arr(self, arr):            return (arr,)
-    def it_preproc(self, p, b):         pass
-    def get_bb(self, p, b):             raise NotImplementedError('Please implement get_bb')
-    def get_W(self, p, b, bb):          return None
+    def it_preproc(self, p, b):         return {}
+    def get_bb(self, p, b, state):      raise NotImplementedError('Please implement get_bb')
+    def get_W(self, p, b, bb, state):   return None
     def refine_point(self, arrs, p, W): raise NotImplementedError('Please implement refine_point')
 
+    def proc_arr_bb(self, arr, bb): # Only processes the part of the array within bb
+        bb_arr = array_bb(arr)
+        bb_proc = stackify((torch.max(bb[0]-self.hw_proc, bb_arr[0]), torch.min(bb[1]+self.hw_proc, bb_arr[1])))
+        return tuple(bb_array(arr, bb-bb_proc[0]) for arr in self.proc_arr(bb_array(arr, bb_proc)))
+
+    def proc_arr_batch(self, arrs):             return (arrs,)
+    def it_preproc_batch(self, ps, bs):         raise NotImplementedError('Please implement it_preproc_batch')
+    def get_bb_batch(self, ps, bs, idx, state):        return state['bbs'][idx]+ps.round()[:, None]
+    def get_W_batch(self, ps, bs, pss_win, idx, state): return None
+    def refine_point_batch(self, arrs, Ws):            raise NotImplementedError('Please implement refine_point_batch')
+
     def __call__(self, arr, ps, bs):
-        arrs = self.proc_arr(arr)
+        with torch_only(): # Inputs are tensors, so skip numpy conversions of utility functions
+            if self.batch: return self.call_batch(arr, ps, bs)
+            else:          return self.call_serial(arr, ps, bs)
+
+    def call_serial(self, arr, ps, bs):
+        sparse = self.sparse or not torch.is_tensor(arr) # Only convert and process the array within each bounding box
+        if not sparse: arrs = self.proc_arr(arr)
         bb_arr = array_bb(arr)
         ps_refined = []
         for idx, (p, b) in enumerate(zip(ps, bs)):
-            self.it_preproc(p, b)
-            b_init = b
+            state = self.it_preproc(p, b)
+            b_init, arrs_bbs = b, {} # Points usually revisit bounding boxes as they converge, so cache them
             for it in torch.arange(self.cutoff_it):
                 p_prev = p
-                bb = self.get_bb(p, b)
-                if not is_bb_in_bb(bb, bb_arr): p = arr.new_full(2, math.nan); break
-                W = self.get_W(p, b, bb)
-                p = self.refine_point(tuple(bb_array(arr, bb) for arr in arrs), p-bb[0], W)+bb[0]
+                bb = self.get_bb(p, b, state)
+                if not is_bb_in_bb(bb, bb_arr): p = arr.new_full((2,), math.nan); break
+                W = self.get_W(p, b, bb, state)
+                if sparse:
+                    key = tuple(bb.flatten().tolist())
+                    if key not in arrs_bbs: arrs_bbs[key] = self.proc_arr_bb(arr, bb)
+                    arrs_bb = arrs_bbs[key]
+                else:
+                    arrs_bb = tuple(bb_array(arr, bb) for arr in arrs)
+                p = self.refine_point(arrs_bb, p-bb[0], W)+bb[0]
                 if torch.any(torch.isnan(p)): break
-                if not is_p_in_b(p, b_init):    p = arr.new_full(2, math.nan); break
+                if not is_p_in_b(p, b_init):    p = arr.new_full((2,), math.nan); break
                 if torch.norm(p-p_prev) < self.cutoff_norm: break
                 b = b-p_prev+p
             ps_refined.append(p)
         return stackify(tuple(ps_refined))
 
+    def call_batch(self, arr, ps, bs):
+        sparse = self.sparse or not torch.is_tensor(arr)
+        if not sparse: arrs = self.proc_arr(arr)
+        bb_arr = array_bb(arr)
+        ps, bs = ps.clone(), stackify(tuple(bs)).clone()
+        state = self.it_preproc_batch(ps, bs)
+        bs_init = bs.clone()
+        idx = torch.arange(len(ps), device=ps.device)
+
+        # Get fixed size window which contains every point's bounding box
+        bbs = self.get_bb_batch(ps, bs, idx, state)-ps.round()[:, None]
+        bb_win = stackify((bbs[:, 0].min(dim=0).values, bbs[:, 1].max(dim=0).values))
+        sz_win, ps_win = tuple(bb_sz(bb_win).long()), grid2ps(*bb_grid(bb_win))
+        h = self.hw_proc
+        bb_win_proc = stackify((bb_win[0]-h, bb_win[1]+h))
+        sz_win_proc, ps_win_proc = tuple(bb_sz(bb_win_proc).long()), grid2ps(*bb_grid(bb_win_proc))
+        ps_cache, arrs_cache = ps.new_full(ps.shape, math.nan), None # Window centers and processed windows of each point
+        for it in torch.arange(self.cutoff_it):
+            ps_prev = ps[idx]
+            bbs = self.get_bb_batch(ps_prev, bs[idx], idx, state)
+            mask = torch.all((bbs[:, 0] >= bb_arr[0]) & (bbs[:, 1] <= bb_arr[1]), dim=1)
+            ps[idx[~mask]] = math.nan
+            idx, ps_prev, bbs = idx[mask], ps_prev[mask], bbs[mask]
+            if len(idx) == 0: break
+
+            # Extract windows; pixels outside of each point's bounding box get zero weight
+            pss_win = ps_prev.round()[:, None]+ps_win
+            Ws = torch.all((pss_win >= bbs[:, None, 0]) & (pss_win <= bbs[:, None, 1]), dim=2).to(ps.dtype)
+            W = self.get_W_batch(ps_prev, bs[idx], pss_win, idx, state)
+            if W is not None: Ws = Ws*W
+            if sparse: # Only convert and process pixels within windows which arent cached
+                mask_miss = torch.any(ps_cache[idx] != ps_prev.round(), dim=1)
+                if torch.any(mask_miss):
+                    xs, ys = (ps_prev[mask_miss].round()[:, None]+ps_win_proc).long().unbind(dim=2)
+                    arrs_win = self.proc_arr_batch(arr[ys.clamp(0, arr.shape[0]-1),
+                                                       xs.clamp(0, arr.shape[1]-1)].reshape(-1, *sz_win_proc))
+                    arrs_win = tuple(arr_win[:, h:sz_win_proc[0]-h, h:sz_win_proc[1]-h] for arr_win in arrs_win)
+                    if arrs_cache is None: arrs_cache = tuple(arr_win.new_empty((len(ps), *sz_win)) for arr_win in arrs_win)
+                    for arr_cache, arr_win in zip(arrs_cache, arrs_win): arr_cache[idx[mask_miss]] = arr_win
+                    ps_cache[idx[mask_miss]] = ps_prev[mask_miss].round()
+                arrs_win = tuple(arr_cache[idx] for arr_cache in arrs_cache)
+            else:
+                xs, ys = pss_win.long().unbind(dim=2)
+                arrs_win = tuple(arr[ys.clamp(0, arr.shape[0]-1),
+                                     xs.clamp(0, arr.shape[1]-1)].reshape(-1, *sz_win) for arr in arrs)
+            ps[idx] = self.refine_point_batch(arrs_win, Ws.reshape(-1, *sz_win))+pss_win[:, 0]
+
+            # Update masks
+            mask_nan = torch.any(torch.isnan(ps[idx]), dim=1)
+            mask_out = ~mask_nan & ~is_ps_in_bs(ps[idx], bs_init[idx])
+            mask_cvg = torch.norm(ps[idx]-ps_prev, dim=1) < self.cutoff_norm
+            ps[idx[mask_out]] = math.nan
+            mask = ~(mask_nan | mask_out | mask_cvg)
+            bs[idx[mask]] += (ps[idx[mask]]-ps_prev[mask])[:, None]
+            idx = idx[mask]
+            if len(idx) == 0: break
+        return ps
+
 # Cell
 class CheckerRefiner(CPRefiner):
-    def __init__(self, hw_min, hw_max, cutoff_it, cutoff_norm):
-        super().__init__(cutoff_it, cutoff_norm)
+    def __init__(self, hw_min, hw_max, cutoff_it, cutoff_norm, batch=False, sparse=False):
+        super().__init__(cutoff_it, cutoff_norm, batch, sparse)
         assert_allclose(type(hw_min), int)
         assert_allclose(type(hw_max), int)
         self.hw_min, self.hw_max = hw_min, hw_max
@@ -57,21 +144,35 @@ class CheckerRefiner(CPRefiner):
         d_min = min([pld(p, l) for l in b_ls(b)])
         hw = torch.floor(d_min/math.sqrt(2))
         hw = hw.clamp(self.hw_min, self.hw_max)
-        self.hw = hw
-        self.bb = stackify(((-hw, -hw),
-                            ( hw,  hw)))
+        return {'hw': hw,
+                'bb': stackify(((-hw, -hw),
+                                ( hw,  hw)))}
 
-    def get_bb(self, p, b): return self.bb+p.round()
+    def get_bb(self, p, b, state): return state['bb']+p.round()
 
-    def get_W(self, p, b, bb):
+    def get_W(self, p, b, bb, state):
         zero = p.new_tensor(0)
 
-        sigma = self.hw/2
+        sigma = state['hw']/2
         cov = stackify(((sigma**2,     zero),
                         (    zero, sigma**2)))
         d = MultivariateNormal(p, covariance_matrix=cov)
         return torch.exp(d.log_prob(grid2ps(*bb_grid(bb)))).reshape(tuple(bb_sz(bb).long()))
 
+    def it_preproc_batch(self, ps, bs):
+        vs = bs.roll(-1, dims=1)-bs
+        ds = torch.abs(vs[:, :, 0]*(ps[:, None, 1]-bs[:, :, 1]) -
+                       vs[:, :, 1]*(ps[:, None, 0]-bs[:, :, 0]))/torch.norm(vs, dim=2) # point to line distances
+        hws = torch.floor(ds.min(dim=1).values/math.sqrt(2))
+        hws = hws.clamp(self.hw_min, self.hw_max)
+        return {'hws': hws,
+                'bbs': stackify(((-hws, -hws),
+                                 ( hws,  hws)), dim=1)}
+
+    def get_W_batch(self, ps, bs, pss_win, idx, state): # Unnormalized gaussian is fine for weighted least squares
+        sigmas = state['hws'][idx]/2
+        return torch.exp(-((pss_win-ps[:, None])**2).sum(dim=2)/(2*sigmas[:, None]**2))
+
 # Cell
 @numpyify
 def checker_opencv(arr_dx, arr_dy, W=None):
@@ -88,29 +189,66 @@ def checker_opencv(arr_dx, arr_dy, W=None):
     # Convert back to unconditioned points
     return pmm(p, torch.inverse(T), aug=True)
 
+# Cell
+@numpyify
+def checker_opencv_batch(arrs_dx, arrs_dy, Ws=None):
+    if Ws is None: Ws = torch.ones_like(arrs_dx)
+
+    # Condition array points
+    pss = array_ps(arrs_dx[0]).expand(len(arrs_dx), -1, -1)
+    Ts = condition_mat_batch(pss, Ws.reshape(len(Ws), -1) > 0)
+    pss_cond = pmm_batch(pss, Ts, aug=True)
+
+    # Form linear systems
+    As = stackify((arrs_dx.reshape(len(arrs_dx), -1), arrs_dy.reshape(len(arrs_dy), -1)), dim=2)
+    bs = (As*pss_cond).sum(dim=2)
+
+    # Get weighted least squares estimates
+    ps = wlstsq_batch(As, bs, Ws)
+
+    # Convert back to unconditioned points
+    return pmm_batch(ps[:, None], torch.inverse(Ts), aug=True)[:, 0]
+
 # Cell
 class OpenCVCheckerRefiner(CheckerRefiner):
-    def __init__(self, hw_min, hw_max, cutoff_it, cutoff_norm):
-        super().__init__(hw_min, hw_max, cutoff_it, cutoff_norm)
+    hw_proc = 1
 
-    def proc_arr(self, arr): return grad_array(arr)
+    def __init__(self, hw_min, hw_max, cutoff_it, cutoff_norm, batch=False, sparse=False):
+        super().__init__(hw_min, hw_max, cutoff_it, cutoff_norm, batch, sparse)
+
+    def proc_arr(self, arr):        return grad_array(arr)
+    def proc_arr_batch(self, arrs): return grad_array_batch(arrs)
 
     def refine_point(self, arrs, p, W): return checker_opencv(*arrs, W)
 
+    def refine_point_batch(self, arrs, Ws): return checker_opencv_batch(*arrs, Ws)
+
 # Cell
+@functools.lru_cache(maxsize=None)
+def _skimage_draw(): # Import skimage once, on first use, rather than once per point
+    import skimage.draw
+    return skimage.draw
+
 class EllipseRefiner(CPRefiner):
-    def __init__(self, cutoff_it, cutoff_norm):
-        super().__init__(cutoff_it, cutoff_norm)
+    def __init__(self, cutoff_it, cutoff_norm, batch=False, sparse=False):
+        super().__init__(cutoff_it, cutoff_norm, batch, sparse)
 
     def it_preproc(self, p, b):
         bb = ps_bb(b)
         bb = stackify((bb[0].floor(), bb[1].ceil()))
-        W = p.new_tensor(skimage.draw.polygon2mask(*torch2np((tuple(bb_sz(bb).long()), b-bb[0]))))
-        self.bb, self.W = bb-p.round(), W
+        W = p.new_tensor(_skimage_draw().polygon2mask(*torch2np((tuple(bb_sz(bb).long()), (b-bb[0]).flip(1)))))
+        return {'bb': bb-p.round(), 'W': W}
+
+    def get_bb(self, p, b, state):    return state['bb']+p.round()
+
+    def get_W(self, p, b, bb, state): return state['W']
 
-    def get_bb(self, p, b):    return self.bb+p.round()
+    def it_preproc_batch(self, ps, bs):
+        bbs = stackify((bs.min(dim=1).values.floor(), bs.max(dim=1).values.ceil()), dim=1)
+        return {'bbs': bbs-ps.round()[:, None], 'bs': bs-ps.round()[:, None]}
 
-    def get_W(self, p, b, bb): return self.W
+    def get_W_batch(self, ps, bs, pss_win, idx, state):
+        return is_ps_in_bs(pss_win-ps.round()[:, None], state['bs'][idx][:, None]).to(ps.dtype)
 
 # Cell
 @numpyify
@@ -146,11 +284,53 @@ def ellipse_dualconic(arr_dx, arr_dy, W=None):
     Aq = fit_conic(arr_dx, arr_dy, W)
     return conic2ellipse(Aq)
 
+# Cell
+@numpyify
+def fit_conic_batch(arrs_dx, arrs_dy, Ws=None):
+    if Ws is None: Ws = torch.ones_like(arrs_dx)
+
+    # Condition array points
+    pss = array_ps(arrs_dx[0]).expand(len(arrs_dx), -1, -1)
+    Ts = condition_mat_batch(pss, Ws.reshape(len(Ws), -1) > 0)
+    pss_cond = pmm_batch(pss, Ts, aug=True)
+
+    # Form homogeneous coordinates of lines
+    lss = stackify((arrs_dx.reshape(len(arrs_dx), -1), arrs_dy.reshape(len(arrs_dy), -1)), dim=2)
+    lss = torch.cat([lss, -(lss*pss_cond).sum(dim=2, keepdim=True)], dim=2)
+
+    # Form linear systems
+    As = stackify((lss[:,:,0]**2, lss[:,:,0]*lss[:,:,1], lss[:,:,1]**2, lss[:,:,0]*lss[:,:,2], lss[:,:,1]*lss[:,:,2]), dim=2)
+    bs = -lss[:, :, 2]**2
+
+    # Get weighted least squares estimates
+    aqs_inv = wlstsq_batch(As, bs, Ws)
+
+    # Get conic matrices
+    ones = torch.ones_like(aqs_inv[:, 0])
+    Aqs_inv = stackify(((  aqs_inv[:, 0], aqs_inv[:, 1]/2, aqs_inv[:, 3]/2),
+                        (aqs_inv[:, 1]/2,   aqs_inv[:, 2], aqs_inv[:, 4]/2),
+                        (aqs_inv[:, 3]/2, aqs_inv[:, 4]/2,            ones)), dim=1)
+    Aqs = torch.inverse(Aqs_inv)
+
+    # Rescale conic matrices to take conditioning into account
+    return Ts.transpose(1, 2)@Aqs@Ts
+
+# Cell
+@numpyify
+def ellipse_dualconic_batch(arrs_dx, arrs_dy, Ws=None):
+    Aqs = fit_conic_batch(arrs_dx, arrs_dy, Ws)
+    return conic2ellipse_batch(Aqs)
+
 # Cell
 class DualConicEllipseRefiner(EllipseRefiner):
-    def __init__(self, cutoff_it, cutoff_norm):
-        super().__init__(cutoff_it, cutoff_norm)
+    hw_proc = 1
+
+    def __init__(self, cutoff_it, cutoff_norm, batch=False, sparse=False):
+        super().__init__(cutoff_it, cutoff_norm, batch, sparse)
+
+    def proc_arr(self, arr):        return grad_array(arr)
+    def proc_arr_batch(self, arrs): return grad_array_batch(arrs)
 
-    def proc_arr(self, arr): return grad_array(arr)
+    def refine_point(self, arrs, p, W): return ellipse_dualconic(*arrs, W)[:2]
 
-    def refine_point(self, arrs, p, W): return ellipse_dualconic(*arrs, W)[:2]
\ No newline at end of file
+    def refine_point_batch(self, arrs, Ws): return ellipse_dualconic_batch(*arrs, Ws)[:, :2]
\ No newline at end of file
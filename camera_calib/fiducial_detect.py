@@ -1,53 +1,123 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: fiducial_detect.ipynb (unless otherwise specified).
 
-__all__ = ['DotVisionCheckerDLDetector']
+__all__ = ['label_centroids', 'DotVisionCheckerDLDetector']
 
 # Cell
 import copy
+import io
 import math
 import warnings
 
 import torch
-from skimage.measure import label, regionprops
-from torchvision import transforms
 
 from .utils import *
 
+# Cell
+def label_centroids(masks, n_labels):
+    N, H, W = masks.shape
+    ns, ys, xs = torch.nonzero((masks >= 1) & (masks <= n_labels), as_tuple=True) # Raster order
+    cs, idxs = masks[ns, ys, xs], torch.arange(len(ns), device=masks.device)
+
+    # Get 8-connected neighbors with the same label; missing neighbors point to themselves
+    lut = torch.full((N, H+2, W+2), -1, dtype=torch.long, device=masks.device) # Padded so neighbors are in bounds
+    lut[ns, ys+1, xs+1] = idxs
+    dys = masks.new_tensor([-1, -1, -1,  0, 0,  1, 1, 1], dtype=torch.long)
+    dxs = masks.new_tensor([-1,  0,  1, -1, 1, -1, 0, 1], dtype=torch.long)
+    nbrs = lut[ns[:, None], ys[:, None]+1+dys, xs[:, None]+1+dxs]
+    nbrs = torch.where((nbrs >= 0) & (cs[nbrs] == cs[:, None]), nbrs, idxs[:, None])
+
+    # Label components with their first pixel by propagating minimums; pointer jumping speeds up convergence
+    ls = idxs
+    while True:
+        ls_prev, ls = ls, torch.min(ls, ls[nbrs].min(dim=1).values)
+        ls = ls[ls]
+        if torch.equal(ls, ls_prev): break
+
+    # Get area and centroid of each component
+    as_ = torch.bincount(ls, minlength=len(ls))
+    ps = stackify(tuple(torch.bincount(ls, vs.double(), minlength=len(ls)) for vs in (xs, ys)), dim=1).double()/as_[:, None]
+
+    # Sort components by (mask and label, descending area, first pixel) and take first one of each mask and label;
+    # ties going to the first component matches regionprops
+    rs = idxs[ls == idxs]
+    m = len(idxs)+1
+    rs = rs[torch.argsort(((ns[rs]*n_labels + cs[rs]-1)*m + m-as_[rs])*m + rs)]
+    gs = ns[rs]*n_labels + cs[rs]-1
+    mask = torch.cat((gs.new_ones(min(len(gs), 1), dtype=torch.bool), gs[1:] != gs[:-1]))
+    pss = torch.full((N*n_labels, 2), math.nan, dtype=torch.double, device=masks.device) # Missing labels are nan
+    pss[gs[mask]] = ps[rs[mask]]
+    return pss.reshape(N, n_labels, 2)
+
 # Cell
 class DotVisionCheckerDLDetector():
-    def __init__(self, file_model, device=torch.device('cpu')):
+    sz = 384                     # Network trained on grayscale 384 sized images
+    attrs_exec = ('batch_size',) # Only changes how images are detected, not the result, so not part of cache keys
+
+    def __init__(self, file_model, device=torch.device('cpu'), batch_size=8):
         self.model = torch.jit.load(file_model.as_posix(), map_location=device).eval()
         self.device = device
+        self.batch_size = batch_size
+
+    def __getstate__(self): # torchscript models cant be pickled directly; serialize to bytes instead
+        state = self.__dict__.copy()
+        buffer = io.BytesIO()
+        torch.jit.save(self.model, buffer)
+        state['model'] = buffer.getvalue()
+        return state
+    def __setstate__(self, state):
+        state['model'] = torch.jit.load(io.BytesIO(state['model']), map_location=state['device']).eval()
+        self.__dict__.update(state)
 
     def format_arr(self, arr):
         if arr.min() < 0: warnings.warn('Value less than zero detected')
         if arr.max() > 1: warnings.warn('Value greater than 1 detected')
 
         arr = arr.float()                   # Must be single precision
-        arr = imresize(arr, 384)            # Network trained on grayscale 384 sized images
+        if torch.is_tensor(arr): arr = imresize(arr, self.sz)
+        else:                    arr = arr.imresize(self.sz) # Lazy arrays only convert sampled pixels
         arr = rescale(arr, (0, 1), (-1, 1)) # Network trained on images between [-1,1]
         arr = arr[None, None]               # Add batch and channel dimension
         arr = arr.to(self.device)           # Move to device
         return arr
 
-    def get_mask(self, arr):
+    def get_masks(self, arrs):
         with torch.no_grad():
-            mask = self.model(self.format_arr(arr)) # Inference
-            mask = mask.to(arr.device)              # Make sure its in the same device as array
-            mask = mask.argmax(dim=1)               # Convert from scores to labels
-            mask = mask.squeeze(0)                  # Remove batch dimension
-        return mask
-
-    def __call__(self, arr):
-        mask = self.get_mask(arr)
-
-        # Extract fiducial points from mask
-        ps_f = arr.new_full((4,2), math.nan)
-        for idx, p_f in enumerate(ps_f):
-            regions = regionprops(label(torch2np(mask) == (idx+1))) # regionprops doesnt work for gpu
-            if len(regions) > 0:
-                region = regions[arr.new_tensor([r.area for r in regions]).argmax()]
-                ps_f[idx] = arr.new_tensor(reverse(region.centroid))
-        ps_f *= (shape(arr)/shape(mask)).mean()
-
-        return ps_f
\ No newline at end of file
+            masks = self.model(torch.cat([self.format_arr(arr) for arr in arrs])) # Batched inference
+            masks = masks.to(arrs[0].device)                                      # Make sure its in the same device as arrays
+            masks = masks.argmax(dim=1)                                           # Convert from scores to labels
+        return masks
+
+    def get_mask(self, arr): return self.get_masks([arr])[0]
+
+    def get_pss_f(self, arrs, masks):
+        pss_f = label_centroids(masks, 4) # Extract fiducial points from masks
+        return [ps_f.to(dtype=arr.dtype, device=arr.device)*(shape(arr)/shape(mask)).mean()
+                for arr, mask, ps_f in zip(arrs, masks, pss_f)]
+
+    def batches(self, arrs): # Batches consecutive arrays with the same shape
+        arrs_batch = []
+        for arr in arrs:
+            if len(arrs_batch) == self.batch_size or (len(arrs_batch) > 0 and arr.shape != arrs_batch[0].shape):
+                yield arrs_batch
+                arrs_batch = []
+            arrs_batch.append(arr)
+        if len(arrs_batch) > 0: yield arrs_batch
+
+    def detect_batch(self, arrs):
+        pss_f = []
+        for arrs_batch in self.batches(arrs):
+            pss_f += self.get_pss_f(arrs_batch, self.get_masks(arrs_batch))
+        return pss_f
+
+    def __call__(self, arr): return self.detect_batch([arr])[0]
+
+    def detect_imgs(self, imgs, dtype=torch.float, device=None): # Images supply reduced resolution arrays directly
+        pss_f = []
+        for idx in range(0, len(imgs), self.batch_size): # Only load a batch of arrays at a time
+            imgs_batch = imgs[idx:idx+self.batch_size]
+            arrs = [img.array_gs_resized(self.sz, dtype, device) for img in imgs_batch]
+            pss_f += [ps_f*(arr.new_tensor(img.size)/shape(arr)).mean()
+                      for img, arr, ps_f in zip(imgs_batch, arrs, self.detect_batch(arrs))]
+        return pss_f
+
+    def detect_img(self, img, dtype=torch.float, device=None): return self.detect_imgs([img], dtype, device)[0]
\ No newline at end of file
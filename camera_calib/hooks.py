@@ -0,0 +1,75 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: hooks.ipynb (unless otherwise specified).
+
+__all__ = ['hook', 'hooked', 'replay', 'stage', 'counter', 'Tracer', 'trace']
+
+# Cell
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+# Cell
+_hooks = []
+
+# Cell
+def _emit(event):
+    for hook in list(_hooks): hook(event)
+
+# Cell
+def _event(name, ph, t, args):
+    return {'name': name, 'ph': ph, 'ts': t*1e6, 'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+
+# Cell
+@contextmanager
+def hook(f):
+    _hooks.append(f)
+    try:     yield f
+    finally: _hooks.remove(f)
+
+# Cell
+def hooked(): return len(_hooks) > 0
+
+# Cell
+def replay(events):
+    for event in events: _emit(event)
+
+# Cell
+class _NullStage:
+    def __enter__(self):       return {}
+    def __exit__(self, *args): return False
+
+# Cell
+_null_stage = _NullStage()
+
+# Cell
+@contextmanager
+def _stage(name, args):
+    t = time.perf_counter()
+    try:     yield args
+    finally: _emit({**_event(name, 'X', t, args), 'dur': (time.perf_counter()-t)*1e6})
+
+# Cell
+def stage(name, **args): return _stage(name, args) if _hooks else _null_stage
+
+# Cell
+def counter(name, **values):
+    if _hooks: _emit(_event(name, 'C', time.perf_counter(), values))
+
+# Cell
+class Tracer:
+    def __init__(self): self.events = []
+    def __call__(self, event): self.events.append(event)
+
+    def save(self, file_trace):
+        Path(file_trace).write_text(json.dumps({'traceEvents': self.events, 'displayTimeUnit': 'ms'}))
+
+# Cell
+@contextmanager
+def trace(file_trace=None):
+    tracer = Tracer()
+    try:
+        with hook(tracer): yield tracer
+    finally:
+        if file_trace is not None: tracer.save(file_trace)
\ No newline at end of file
@@ -1,14 +1,17 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: image.ipynb (unless otherwise specified).
 
-__all__ = ['Img', 'FileImg', 'File16bitImg', 'ArrayImg']
+__all__ = ['Img', 'ArrayCache', 'Array16bit', 'FileImg', 'File16bitImg', 'ArrayImg']
 
 # Cell
+import threading
 import warnings
+from collections import OrderedDict
 
 import numpy as np
 import torch
 from PIL import Image
 
+from .hooks import stage
 from .utils import *
 
 # Cell
@@ -28,13 +31,114 @@ class Img:
         elif len(sz) == 2:              pass
         else:                           raise RuntimeError(f'Invalid shape: {arr.shape}')
         return arr
+    def array_gs_resized(self, sz, dtype, device=None): # Subclasses can supply a reduced resolution array directly
+        arr = self.array_gs(dtype, device)
+        return imresize(arr, sz) if torch.is_tensor(arr) else arr.imresize(sz)
 
     def __repr__(self): return f'{self.__class__.__name__}({self.name})'
 
+# Cell
+class ArrayCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.arrs = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock() # Images can be read from multiple threads
+
+    def __len__(self): return len(self.arrs)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.arrs:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.arrs.move_to_end(key)
+            return self.arrs[key]
+
+    def pop(self, key):
+        with self.lock:
+            arr = self.arrs.pop(key)
+            self.nbytes -= arr.numel()*arr.element_size()
+            return arr
+
+    def put(self, key, arr):
+        with self.lock:
+            if key in self.arrs: self.pop(key)
+            nbytes = arr.numel()*arr.element_size()
+            if nbytes > self.max_bytes: return arr # Too big to cache
+            while self.nbytes + nbytes > self.max_bytes: self.pop(next(iter(self.arrs))) # Evict least recently used
+            self.arrs[key] = arr
+            self.nbytes += nbytes
+            return arr
+
+    def clear(self):
+        with self.lock:
+            self.arrs.clear()
+            self.nbytes = 0
+
+    def __getstate__(self): return {'max_bytes': self.max_bytes} # Cached arrays (and the lock) arent pickled, e.g. for workers
+    def __setstate__(self, state): self.__init__(state['max_bytes'])
+
+    def __repr__(self):
+        return (f'{self.__class__.__name__}(n={len(self)}, nbytes={self.nbytes}, max_bytes={self.max_bytes}, '
+                f'hits={self.hits}, misses={self.misses})')
+
+# Cell
+class Array16bit:
+    def __init__(self, arr, dtype=torch.double, device=None):
+        self.arr = arr.astype(np.uint16, copy=False) # Zero copy if already 16 bit
+        self.arr.setflags(write=False)
+        self.proto = torch.empty(0, dtype=dtype, device=device)
+
+    @property
+    def shape(self):  return torch.Size(self.arr.shape)
+    @property
+    def dtype(self):  return self.proto.dtype
+    @property
+    def device(self): return self.proto.device
+
+    def numel(self):        return self.arr.size
+    def element_size(self): return self.arr.itemsize
+
+    def to(self, dtype=None, device=None, copy=False): # Raw buffer is read only, so it never needs copying
+        if dtype  is None: dtype  = self.dtype
+        if device is None: device = self.device
+        return Array16bit(self.arr, dtype, device)
+    def float(self):  return self.to(torch.float)
+    def double(self): return self.to(torch.double)
+
+    def new_tensor(self, *args, **kwargs): return self.proto.new_tensor(*args, **kwargs)
+    def new_full(self, *args, **kwargs):   return self.proto.new_full(*args, **kwargs)
+    def new_zeros(self, *args, **kwargs):  return self.proto.new_zeros(*args, **kwargs)
+
+    def convert(self, arr):
+        arr = np2torch(np.asarray(arr).astype(torch2np(self.proto).dtype)).to(self.device)
+        return arr/(2**16-1) # Scale between 0 and 1 for 16 bit image
+
+    def __getitem__(self, idx):
+        if not isinstance(idx, tuple): idx = (idx,)
+        return self.convert(self.arr[tuple(torch2np(i) if torch.is_tensor(i) else i for i in idx)])
+    def min(self): return self.convert(self.arr.min())
+    def max(self): return self.convert(self.arr.max())
+
+    def imresize(self, sz): # Same as bilinear imresize with align_corners=True, but only converts sampled pixels
+        if not isinstance(sz, tuple): sz = tuple((shape(self)//(shape(self)/sz).min()).long())
+        ys, xs = [torch.linspace(0, s_in-1, s_out, dtype=torch.double, device=self.device) # Precise sample points
+                  for s_in, s_out in zip(self.shape, sz)]
+        ys0, xs0 = ys.floor().long(), xs.floor().long()
+        ys1, xs1 = (ys0+1).clamp(max=self.shape[0]-1), (xs0+1).clamp(max=self.shape[1]-1)
+        wys, wxs = (ys-ys0)[:, None].to(self.dtype), (xs-xs0)[None, :].to(self.dtype)
+        return (self[ys0[:, None], xs0]*(1-wys)*(1-wxs) + self[ys0[:, None], xs1]*(1-wys)*wxs +
+                self[ys1[:, None], xs0]*wys*(1-wxs)     + self[ys1[:, None], xs1]*wys*wxs)
+
 # Cell
 class FileImg(Img):
-    def __init__(self, file_img):
+    def __init__(self, file_img, cache=None):
         self.file_img = file_img
+        self.cache = cache
 
     def exists(self): return self.file_img.exists()
 
@@ -43,15 +147,42 @@ class FileImg(Img):
     @property
     def size(self):   return reverse(Image.open(self.file_img).size) # fast
 
-# Cell
-class File16bitImg(FileImg):
-    def __init__(self, file_img):
-        super().__init__(file_img)
+    def cached(self, key, f, device):
+        key = (self.file_img.resolve().as_posix(), self.file_img.stat().st_mtime_ns) + key
+        arr = self.cache.get(key)
+        if arr is None: arr = self.cache.put(key, f())
+        return arr.to(device=device, copy=True) # Copy so cached array cant be modified in place
 
+    def _array(self, dtype, device): raise NotImplementedError('Please implement _array')
     def array(self, dtype, device=None):
-        arr = np2torch(np.array(Image.open(self.file_img))).to(dtype=dtype, device=device)
-        arr /= 2**16-1 # Scale between 0 and 1 for 16 bit image
-        return arr
+        if self.cache is None: return self._array(dtype, device)
+        return self.cached((dtype,), lambda: self._array(dtype, None), device)
+
+    def _array_gs_resized(self, sz, dtype, device): return super().array_gs_resized(sz, dtype, device)
+    def array_gs_resized(self, sz, dtype, device=None):
+        if self.cache is None: return self._array_gs_resized(sz, dtype, device)
+        return self.cached((dtype, sz), lambda: self._array_gs_resized(sz, dtype, None), device)
+
+# Cell
+class File16bitImg(FileImg):
+    def __init__(self, file_img, cache=None, lazy=False):
+        super().__init__(file_img, cache)
+        self.lazy = lazy
+
+    def _array(self, dtype, device):
+        with stage('decode', img=self.name):
+            arr = np.asarray(Image.open(self.file_img))
+            if self.lazy: return Array16bit(arr, dtype, device)
+            arr = np2torch(arr).to(dtype=dtype, device=device)
+            arr /= 2**16-1 # Scale between 0 and 1 for 16 bit image
+            return arr
+    def array(self, dtype, device=None): # Lazy and eager arrays of the same file are cached separately
+        if self.cache is None or not self.lazy: return super().array(dtype, device)
+        return self.cached((dtype, 'lazy'), lambda: self._array(dtype, None), device)
+
+    def _array_gs_resized(self, sz, dtype, device): # Only converts sampled pixels
+        with stage('decode', img=self.name):
+            return Array16bit(np.asarray(Image.open(self.file_img)), dtype, device).imresize(sz)
 
 # Cell
 class ArrayImg(Img):
@@ -1,8 +1,9 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: modules.ipynb (unless otherwise specified).
 
-__all__ = ['tensors2parameters', 'Inversible', 'Inverse', 'assert_inversible', 'Translation', 'Rotation',
-           'EulerRotation', 'InversibleSequential', 'Rigid', 'Rigids', 'Normalize', 'Augment', 'NoDistortion',
-           'Heikkila97Distortion', 'Wang08Distortion', 'a2A', 'Cam', 'CamSF']
+__all__ = ['tensors2parameters', 'Inversible', 'Inverse', 'assert_inversible', 'assert_jacobian', 'Translation',
+           'Rotation', 'EulerRotation', 'InversibleSequential', 'Rigid', 'Rigids', 'Normalize', 'Augment',
+           'NoDistortion', 'heikkila97_distort', 'heikkila97_distort_jacobian', 'Heikkila97Distortion',
+           'wang08_distort', 'wang08_distort_jacobian', 'Wang08Distortion', 'a2A', 'Cam', 'CamSF', 'Rig']
 
 # Cell
 import torch
@@ -48,6 +49,19 @@ def assert_inversible(m, x, y, **kwargs):
     assert_allclose(m(x),          y, **kwargs)
     assert_allclose(Inverse(m)(y), x, **kwargs)
 
+# Cell
+def assert_jacobian(m, ps, **kwargs):
+    ps = ps.clone().requires_grad_()
+    ys, params = m(ps), list(m.parameters())
+    Js_ps, Js_param = [], []
+    for y in ys.flatten():
+        gs = torch.autograd.grad(y, [ps]+params, retain_graph=True)
+        Js_ps.append(gs[0])
+        Js_param.append(torch.cat([g.flatten() for g in gs[1:]]))
+    Js_ps = torch.diagonal(stackify(tuple(Js_ps)).reshape(*ys.shape, *ps.shape), dim1=0, dim2=2).permute(2, 0, 1)
+    Js_param = stackify(tuple(Js_param)).reshape(*ys.shape, -1)
+    assert_allclose(m.jacobian(ps.detach()), (Js_ps, Js_param), **kwargs)
+
 # Cell
 class Translation(Inversible):
     def __init__(self, t):
@@ -66,6 +80,10 @@ class Translation(Inversible):
         return ps + t
     def inverse(self, ps): return self.forward(ps, inverse=True)
 
+    def jacobian(self, ps):
+        eye = torch.eye(3, dtype=ps.dtype, device=ps.device).expand(len(ps), 3, 3)
+        return eye, eye
+
 # Cell
 class Rotation(Inversible):
     def __init__(self):
@@ -82,6 +100,8 @@ class Rotation(Inversible):
         return pmm(ps, R)
     def inverse(self, ps): return self.forward(ps, inverse=True)
 
+    def jacobian(self, ps): raise NotImplementedError('Please implement jacobian() method')
+
 # Cell
 class EulerRotation(Rotation):
     def __init__(self, R):
@@ -94,6 +114,10 @@ class EulerRotation(Rotation):
 
     def r2R(self): return euler2R(self.euler)
 
+    def jacobian(self, ps):
+        R, dRs = self.r2R(), euler2R_jacobian_batch(self.euler[None])[0]
+        return R.expand(len(ps), 3, 3), torch.einsum('kij,nj->nik', dRs, ps)
+
 # Cell
 class InversibleSequential(Inversible):
     def __init__(self, ms):
@@ -121,6 +145,11 @@ class Rigid(InversibleSequential):
 
     def inverse_param(self): return invert_rigid(self.forward_param())
 
+    def jacobian(self, ps):
+        Js_R_ps, Js_R = self.ms[0].jacobian(ps)
+        Js_t_ps, Js_t = self.ms[1].jacobian(self.ms[0](ps))
+        return Js_t_ps@Js_R_ps, torch.cat([Js_t_ps@Js_R, Js_t], dim=2)
+
 # Cell
 class Rigids(InversibleSequential):
     def __init__(self, rigids):
@@ -152,6 +181,40 @@ class Augment(Inversible):
 # Cell
 NoDistortion = nn.Identity
 
+# Cell
+def heikkila97_distort(ps, d):
+    k1, k2, p1, p2 = d.unbind(-1)
+    xs, ys = ps[..., 0], ps[..., 1]
+
+    # Radial distortion
+    rs = xs**2 + ys**2
+    xs_r = xs*(1 + k1*rs + k2*rs**2)
+    ys_r = ys*(1 + k1*rs + k2*rs**2)
+
+    # Decentering distortion
+    xs_d = xs_r + 2*p1*xs*ys + p2*(3*xs**2 + ys**2)
+    ys_d = ys_r + p1*(xs**2 + 3*ys**2) + 2*p2*xs*ys
+
+    return stackify((xs_d, ys_d), dim=-1)
+
+# Cell
+def heikkila97_distort_jacobian(ps, d):
+    k1, k2, p1, p2 = d.unbind(-1)
+    xs, ys = ps[..., 0], ps[..., 1]
+
+    # Radial distortion
+    rs = xs**2 + ys**2
+    fs, dfs = 1 + k1*rs + k2*rs**2, k1 + 2*k2*rs
+
+    # w.r.t. points
+    J_ps = stackify((stackify((fs + 2*xs**2*dfs + 2*p1*ys + 6*p2*xs, 2*xs*ys*dfs + 2*p1*xs + 2*p2*ys), dim=-1),
+                     stackify((2*xs*ys*dfs + 2*p1*xs + 2*p2*ys, fs + 2*ys**2*dfs + 6*p1*ys + 2*p2*xs), dim=-1)), dim=-2)
+
+    # w.r.t. parameters
+    J_d = stackify((stackify((xs*rs, xs*rs**2,      2*xs*ys, 3*xs**2 + ys**2), dim=-1),
+                    stackify((ys*rs, ys*rs**2, xs**2 + 3*ys**2,        2*xs*ys), dim=-1)), dim=-2)
+    return J_ps, J_d
+
 # Cell
 class Heikkila97Distortion(nn.Module):
     def __init__(self, d):
@@ -162,20 +225,47 @@ class Heikkila97Distortion(nn.Module):
         k1, k2, p1, p2 = self.d
         return f'{self.__class__.__name__}(k1:{k1:.4} k2:{k2:.4} p1:{p1:.4} p2:{p2:.4})'
 
-    def forward(self, ps):
-        k1, k2, p1, p2 = self.d
-        xs, ys = ps[:,0], ps[:,1]
+    def forward(self, ps): return heikkila97_distort(ps, self.d)
+
+    def jacobian(self, ps): return heikkila97_distort_jacobian(ps, self.d)
+
+# Cell
+def wang08_distort(ps, d):
+    k1, k2, p, t = d.unbind(-1)
+    xs, ys = ps[..., 0], ps[..., 1]
 
-        # Radial distortion
-        rs = xs**2 + ys**2
-        xs_r = xs*(1 + k1*rs + k2*rs**2)
-        ys_r = ys*(1 + k1*rs + k2*rs**2)
+    # Radial distortion
+    rs = xs**2 + ys**2
+    xs_r = xs*(1 + k1*rs + k2*rs**2)
+    ys_r = ys*(1 + k1*rs + k2*rs**2)
 
-        # Decentering distortion
-        xs_d = xs_r + 2*p1*xs*ys + p2*(3*xs**2 + ys**2)
-        ys_d = ys_r + p1*(xs**2 + 3*ys**2) + 2*p2*xs*ys
+    # Image plane (small angle approximation) rotation distortion
+    xs_d = xs_r/(-p*xs_r + t*ys_r + 1)
+    ys_d = ys_r/(-p*xs_r + t*ys_r + 1)
 
-        return stackify((xs_d, ys_d), dim=1)
+    return stackify((xs_d, ys_d), dim=-1)
+
+# Cell
+def wang08_distort_jacobian(ps, d):
+    k1, k2, p, t = d.unbind(-1)
+    xs, ys = ps[..., 0], ps[..., 1]
+
+    # Radial distortion
+    rs = xs**2 + ys**2
+    fs, dfs = 1 + k1*rs + k2*rs**2, k1 + 2*k2*rs
+    xs_r, ys_r = xs*fs, ys*fs
+    ws = -p*xs_r + t*ys_r + 1
+
+    # Jacobians of radial distortion and denominator; last dimension is (x, y, k1, k2, p, t)
+    zeros = torch.zeros_like(ws)
+    Js_r = stackify((stackify((fs + 2*xs**2*dfs,      2*xs*ys*dfs, xs*rs, xs*rs**2, zeros, zeros), dim=-1),
+                     stackify((     2*xs*ys*dfs, fs + 2*ys**2*dfs, ys*rs, ys*rs**2, zeros, zeros), dim=-1)), dim=-2)
+    Js_w = -p[..., None]*Js_r[..., 0, :] + t[..., None]*Js_r[..., 1, :]
+    Js_w = Js_w + stackify((zeros, zeros, zeros, zeros, -xs_r, ys_r), dim=-1)
+
+    # Quotient rule
+    Js = (Js_r*ws[..., None, None] - stackify((xs_r, ys_r), dim=-1)[..., None]*Js_w[..., None, :])/ws[..., None, None]**2
+    return Js[..., :2], Js[..., 2:]
 
 # Cell
 class Wang08Distortion(nn.Module):
@@ -187,20 +277,9 @@ class Wang08Distortion(nn.Module):
         k1, k2, p, t = self.d
         return f'{self.__class__.__name__}(k1:{k1:.4} k2:{k2:.4} p:{p:.4} t:{t:.4})'
 
-    def forward(self, ps):
-        k1, k2, p, t = self.d
-        xs, ys = ps[:,0], ps[:,1]
-
-        # Radial distortion
-        rs = xs**2 + ys**2
-        xs_r = xs*(1 + k1*rs + k2*rs**2)
-        ys_r = ys*(1 + k1*rs + k2*rs**2)
+    def forward(self, ps): return wang08_distort(ps, self.d)
 
-        # Image plane (small angle approximation) rotation distortion
-        xs_d = xs_r/(-p*xs_r + t*ys_r + 1)
-        ys_d = ys_r/(-p*xs_r + t*ys_r + 1)
-
-        return stackify((xs_d, ys_d), dim=1)
+    def jacobian(self, ps): return wang08_distort_jacobian(ps, self.d)
 
 # Cell
 def a2A(alpha_x, alpha_y, x_o, y_o):
@@ -246,4 +325,129 @@ class CamSF(Cam):
         return a2A(alpha_x=1/alpha,
                    alpha_y=1/alpha,
                    x_o=-x_o/alpha,
-                   y_o=-y_o/alpha)
\ No newline at end of file
+                   y_o=-y_o/alpha)
+
+    def jacobian(self, ps):
+        alpha, x_o, y_o = self.a
+        zeros, ones = ps.new_zeros(len(ps)), ps.new_ones(len(ps))
+        J_ps = alpha*torch.eye(2, dtype=ps.dtype, device=ps.device).expand(len(ps), 2, 2)
+        J_a = stackify(((ps[:, 0],  ones, zeros),
+                        (ps[:, 1], zeros,  ones)), dim=1)
+        return J_ps, J_a
+
+# Cell
+class Rig(nn.Module):
+    def __init__(self, cams, distorts, rigids_cb, idxs_cb, rigids_cam=None, idxs_cam=None):
+        super().__init__()
+        for m in cams:
+            if not isinstance(m, CamSF): raise RuntimeError(f'Dont know how to handle: {type(m)}')
+        for m in distorts:
+            if type(m) != type(distorts[0]) or not isinstance(m, (NoDistortion, Heikkila97Distortion, Wang08Distortion)):
+                raise RuntimeError(f'Dont know how to handle: {type(m)}')
+        for m in rigids_cb + ([] if rigids_cam is None else rigids_cam):
+            if not isinstance(m, Rigid) or not isinstance(m.ms[0], EulerRotation):
+                raise RuntimeError(f'Dont know how to handle: {type(m)}')
+        if idxs_cam is None: idxs_cam = torch.zeros_like(idxs_cb)
+
+        def _stack(ts): return stackify(tuple(t.detach() for t in ts)).clone()
+        self.a = tensors2parameters(_stack([cam.a for cam in cams]))
+        self.d = None
+        if not isinstance(distorts[0], NoDistortion):
+            self.d = tensors2parameters(_stack([distort.d for distort in distorts]))
+        self.euler_cb = tensors2parameters(_stack([rigid.ms[0].euler for rigid in rigids_cb]))
+        self.t_cb     = tensors2parameters(_stack([rigid.ms[1].t     for rigid in rigids_cb]))
+        self.euler_cam, self.t_cam = None, None
+        if rigids_cam is not None:
+            self.euler_cam = tensors2parameters(_stack([rigid.ms[0].euler for rigid in rigids_cam]))
+            self.t_cam     = tensors2parameters(_stack([rigid.ms[1].t     for rigid in rigids_cam]))
+            self.register_buffer('fixed_cam', torch.tensor([not all(p.requires_grad for p in rigid.parameters())
+                                                            for rigid in rigids_cam], device=idxs_cb.device))
+        self.register_buffer('idxs_cb',  idxs_cb)
+        self.register_buffer('idxs_cam', idxs_cam)
+        self.ms = (cams, distorts, rigids_cb, rigids_cam) # Not registered on purpose
+
+    def params_img(self): # Returns parameters for each image
+        params = {'a': self.a[self.idxs_cam], 'euler_cb': self.euler_cb[self.idxs_cb], 't_cb': self.t_cb[self.idxs_cb]}
+        if self.d is not None: params['d'] = self.d[self.idxs_cam]
+        if self.euler_cam is not None:
+            params['euler_cam'] = torch.where(self.fixed_cam[:, None], self.euler_cam.detach(), self.euler_cam)[self.idxs_cam]
+            params['t_cam']     = torch.where(self.fixed_cam[:, None], self.t_cam.detach(),     self.t_cam)[self.idxs_cam]
+        return params
+
+    def forward_img(self, ps, a, euler_cb, t_cb, d=None, euler_cam=None, t_cam=None):
+        # Calibration board => world (or camera) coordinates
+        pss = pmm_batch(ps.expand(len(euler_cb), -1, -1), euler2R_batch(euler_cb)) + t_cb[:, None]
+
+        # World => camera coordinates
+        if euler_cam is not None: pss = pmm_batch(pss - t_cam[:, None], euler2R_batch(euler_cam).transpose(1, 2))
+
+        # Normalize and distort
+        pss = pss[:, :, :2]/pss[:, :, 2:]
+        if   isinstance(self.ms[1][0], Heikkila97Distortion): pss = heikkila97_distort(pss, d[:, None])
+        elif isinstance(self.ms[1][0], Wang08Distortion):     pss = wang08_distort(pss, d[:, None])
+
+        # Apply camera matrix
+        alphas, xs_o, ys_o = a[:, None].unbind(-1)
+        return stackify((alphas*pss[:, :, 0] + xs_o,
+                         alphas*pss[:, :, 1] + ys_o), dim=2)
+
+    def jacobian_img(self, ps, a, euler_cb, t_cb, d=None, euler_cam=None, t_cam=None):
+        num_img, num_p = len(euler_cb), len(ps)
+        eye = torch.eye(3, dtype=ps.dtype, device=ps.device)
+
+        # Calibration board => world (or camera) coordinates
+        Rs = euler2R_batch(euler_cb)
+        pss = pmm_batch(ps.expand(num_img, -1, -1), Rs) + t_cb[:, None]
+        Js = {'euler_cb': torch.einsum('nkij,pj->npik', euler2R_jacobian_batch(euler_cb), ps),
+              't_cb':     eye.expand(num_img, num_p, 3, 3)}
+
+        # World => camera coordinates
+        if euler_cam is not None:
+            Rs_T = euler2R_batch(euler_cam).transpose(1, 2)
+            pss = pss - t_cam[:, None]
+            Js = {name: Rs_T[:, None]@J for name, J in Js.items()}
+            Js['euler_cam'] = torch.einsum('nkji,npj->npik', euler2R_jacobian_batch(euler_cam), pss)
+            Js['t_cam']     = -Rs_T[:, None].expand(num_img, num_p, 3, 3)
+            pss = pmm_batch(pss, Rs_T)
+
+        # Normalize
+        xs, ys, zs = pss.unbind(-1)
+        zeros = torch.zeros_like(zs)
+        J_ps = stackify(((1/zs, zeros, -xs/zs**2),
+                         (zeros, 1/zs, -ys/zs**2)), dim=2)
+        Js = {name: J_ps@J for name, J in Js.items()}
+        pss = pss[:, :, :2]/pss[:, :, 2:]
+
+        # Distort
+        if isinstance(self.ms[1][0], (Heikkila97Distortion, Wang08Distortion)):
+            if isinstance(self.ms[1][0], Heikkila97Distortion): distort, distort_jacobian = heikkila97_distort, heikkila97_distort_jacobian
+            else:                                               distort, distort_jacobian = wang08_distort,     wang08_distort_jacobian
+            J_ps, J_d = distort_jacobian(pss, d[:, None])
+            Js = {name: J_ps@J for name, J in Js.items()}
+            Js['d'] = J_d
+            pss = distort(pss, d[:, None])
+
+        # Apply camera matrix
+        alphas, xs_o, ys_o = a[:, None].unbind(-1)
+        Js = {name: alphas[:, :, None, None]*J for name, J in Js.items()}
+        zeros, ones = torch.zeros_like(pss[:, :, 0]), torch.ones_like(pss[:, :, 0])
+        Js['a'] = stackify(((pss[:, :, 0],  ones, zeros),
+                            (pss[:, :, 1], zeros,  ones)), dim=2)
+        return stackify((alphas*pss[:, :, 0] + xs_o,
+                         alphas*pss[:, :, 1] + ys_o), dim=2), Js
+
+    def forward(self, ps): return self.forward_img(ps, **self.params_img())
+
+    def update_modules(self):
+        cams, distorts, rigids_cb, rigids_cam = self.ms
+        with torch.no_grad():
+            for cam, a in zip(cams, self.a): cam.a.copy_(a)
+            if self.d is not None:
+                for distort, d in zip(distorts, self.d): distort.d.copy_(d)
+            for rigid, euler, t in zip(rigids_cb, self.euler_cb, self.t_cb):
+                rigid.ms[0].euler.copy_(euler)
+                rigid.ms[1].t.copy_(t)
+            if rigids_cam is not None:
+                for rigid, euler, t in zip(rigids_cam, self.euler_cam, self.t_cam):
+                    rigid.ms[0].euler.copy_(euler)
+                    rigid.ms[1].t.copy_(t)
\ No newline at end of file
@@ -0,0 +1,57 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: params.ipynb (unless otherwise specified).
+
+__all__ = ['FORMAT_VERSION', 'save_params', 'load_params']
+
+# Cell
+import json
+from pathlib import Path
+
+import numpy as np
+
+# Cell
+FORMAT_VERSION = 1
+
+# Cell
+def save_params(calib, file_params, obs=True):
+    from .modules import NoDistortion
+
+    def _tolist(x): return x.detach().cpu().tolist()
+
+    file_params = Path(file_params)
+    params = {'version':  FORMAT_VERSION,
+              'As':       [_tolist(cam.get_param()) for cam in calib['cams']],
+              'distorts': [{'model': 'NoDistortion', 'd': []} if isinstance(distort, NoDistortion) else
+                           {'model': type(distort).__name__, 'd': _tolist(distort.d)} for distort in calib['distorts']],
+              'Ms_cam':   [_tolist(rigid_cam.get_param()) for rigid_cam in calib['rigids_cam']],
+              'Ms_cb':    [_tolist(rigid_cb.get_param())  for rigid_cb  in calib['rigids_cb']],
+              'imgs':     [{'name': img.name, 'size': list(img.size), 'idx_cam': img.idx_cam, 'idx_cb': img.idx_cb}
+                           for img in calib['imgs']],
+              'optim':    calib.get('optim', {}), # Older calibrations dont have 'optim'
+              'obs':      {}}
+    if obs:
+        pss_c_p = calib['obs'].unpack() if 'obs' in calib else calib['pss_c_p'] # Older calibrations dont have 'obs'
+        for key, pss in (('pss_c_p', pss_c_p), ('pss_c_p_m', calib['pss_c_p_m'])):
+            file_obs = file_params.with_suffix(f'.{key}.npy')
+            np.save(file_obs, np.stack([ps.detach().cpu().numpy() for ps in pss]))
+            params['obs'][key] = file_obs.name
+    with open(file_params, 'w') as f: json.dump(params, f, indent=1)
+
+# Cell
+def load_params(file_params, mmap=True):
+    file_params = Path(file_params)
+    with open(file_params) as f: params = json.load(f)
+    if params['version'] != FORMAT_VERSION: raise RuntimeError(f'Dont know how to handle version: {params["version"]}')
+
+    def _load_obs(key):
+        if key not in params['obs']: return None
+        return np.load(file_params.parent/params['obs'][key], mmap_mode='r' if mmap else None)
+
+    return {'version':   params['version'],
+            'As':        np.array(params['As']).reshape(-1, 3, 3),
+            'distorts':  [{'model': distort['model'], 'd': np.array(distort['d'])} for distort in params['distorts']],
+            'Ms_cam':    np.array(params['Ms_cam']).reshape(-1, 4, 4),
+            'Ms_cb':     np.array(params['Ms_cb']).reshape(-1, 4, 4),
+            'imgs':      params['imgs'],
+            'optim':     params['optim'],
+            'pss_c_p':   _load_obs('pss_c_p'),
+            'pss_c_p_m': _load_obs('pss_c_p_m')}
\ No newline at end of file
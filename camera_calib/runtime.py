@@ -0,0 +1,139 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: runtime.ipynb (unless otherwise specified).
+
+__all__ = ['Projector', 'load_projector']
+
+# Cell
+import numpy as np
+
+from .params import load_params
+
+# Cell
+def _is_torch(x): return type(x).__module__.split('.')[0] == 'torch'
+
+# Cell
+def _float(ps):
+    if _is_torch(ps): return ps.detach() if ps.is_floating_point() else ps.double()
+    return ps if np.issubdtype(ps.dtype, np.floating) else ps.astype(np.float64)
+
+# Cell
+def _like(x, ps):
+    if _is_torch(ps):
+        import torch
+        return torch.as_tensor(x, dtype=ps.dtype, device=ps.device)
+    return np.asarray(x, dtype=ps.dtype)
+
+# Cell
+def _eps(ps):
+    if _is_torch(ps):
+        import torch
+        return torch.finfo(ps.dtype).eps
+    return np.finfo(ps.dtype).eps
+
+# Cell
+def _stack(xs, ps):
+    if _is_torch(ps):
+        import torch
+        return torch.stack(xs, -1)
+    return np.stack(xs, -1)
+
+# Cell
+def _heikkila97_distort(xs, ys, d):
+    k1, k2, p1, p2 = d
+    rs = xs**2 + ys**2
+    fs = 1 + k1*rs + k2*rs**2
+    return xs*fs + 2*p1*xs*ys + p2*(3*xs**2 + ys**2), ys*fs + p1*(xs**2 + 3*ys**2) + 2*p2*xs*ys
+
+# Cell
+def _heikkila97_distort_jacobian(xs, ys, d):
+    k1, k2, p1, p2 = d
+    rs = xs**2 + ys**2
+    fs, dfs = 1 + k1*rs + k2*rs**2, k1 + 2*k2*rs
+    return (fs + 2*xs**2*dfs + 2*p1*ys + 6*p2*xs, 2*xs*ys*dfs + 2*p1*xs + 2*p2*ys,
+            2*xs*ys*dfs + 2*p1*xs + 2*p2*ys,      fs + 2*ys**2*dfs + 6*p1*ys + 2*p2*xs)
+
+# Cell
+def _wang08_distort(xs, ys, d):
+    k1, k2, p, t = d
+    rs = xs**2 + ys**2
+    fs = 1 + k1*rs + k2*rs**2
+    xs_r, ys_r = xs*fs, ys*fs
+    ws = -p*xs_r + t*ys_r + 1
+    return xs_r/ws, ys_r/ws
+
+# Cell
+def _wang08_distort_jacobian(xs, ys, d):
+    k1, k2, p, t = d
+    rs = xs**2 + ys**2
+    fs, dfs = 1 + k1*rs + k2*rs**2, k1 + 2*k2*rs
+    xs_r, ys_r = xs*fs, ys*fs
+    ws = -p*xs_r + t*ys_r + 1
+
+    # Radial distortion, then quotient rule
+    J_r00, J_r01, J_r11 = fs + 2*xs**2*dfs, 2*xs*ys*dfs, fs + 2*ys**2*dfs
+    J_w0, J_w1 = -p*J_r00 + t*J_r01, -p*J_r01 + t*J_r11
+    return ((J_r00*ws - xs_r*J_w0)/ws**2, (J_r01*ws - xs_r*J_w1)/ws**2,
+            (J_r01*ws - ys_r*J_w0)/ws**2, (J_r11*ws - ys_r*J_w1)/ws**2)
+
+# Cell
+_distorts = {'Heikkila97Distortion': (_heikkila97_distort, _heikkila97_distort_jacobian),
+             'Wang08Distortion':     (_wang08_distort,     _wang08_distort_jacobian)}
+
+# Cell
+def _undistort(xs_d, ys_d, d, distort, jacobian, cutoff_it, cutoff_norm):
+    if cutoff_norm is None: cutoff_norm = 4*_eps(xs_d)
+    xs, ys = xs_d, ys_d
+    for _ in range(cutoff_it):
+        rs_x, rs_y = distort(xs, ys, d)
+        rs_x, rs_y = rs_x - xs_d, rs_y - ys_d
+        J00, J01, J10, J11 = jacobian(xs, ys, d)
+        dets = J00*J11 - J01*J10
+        dxs, dys = (J11*rs_x - J01*rs_y)/dets, (J00*rs_y - J10*rs_x)/dets
+        xs, ys = xs - dxs, ys - dys
+        if not ((abs(dxs) > cutoff_norm) | (abs(dys) > cutoff_norm)).any(): break # Note: non finite points are ignored
+    return xs, ys
+
+# Cell
+class Projector:
+    def __init__(self, As, distorts, Ms_cam, cutoff_it=20, cutoff_norm=None):
+        for distort in distorts:
+            if distort['model'] != 'NoDistortion' and distort['model'] not in _distorts:
+                raise RuntimeError(f'Dont know how to handle: {distort["model"]}')
+        self.As, self.distorts, self.Ms_cam = np.asarray(As), distorts, np.asarray(Ms_cam)
+        self.cutoff_it, self.cutoff_norm = cutoff_it, cutoff_norm
+
+    def __len__(self): return len(self.As)
+
+    def params(self, idx_cam, ps):
+        A, M = _like(self.As[idx_cam], ps), _like(self.Ms_cam[idx_cam], ps)
+        distort = self.distorts[idx_cam]
+        return A, distort['model'], _like(distort['d'], ps), M[:3, :3], M[:3, 3]
+
+    def project(self, ps_w, idx_cam):
+        ps_w = _float(ps_w)
+        A, model, d, R, t = self.params(idx_cam, ps_w)
+
+        # World => camera coordinates, normalize, and distort
+        ps = (ps_w - t)@R
+        xs, ys = ps[..., 0]/ps[..., 2], ps[..., 1]/ps[..., 2]
+        if model in _distorts: xs, ys = _distorts[model][0](xs, ys, d)
+
+        # Apply camera matrix
+        return _stack((A[0, 0]*xs + A[0, 1]*ys + A[0, 2],
+                                    A[1, 1]*ys + A[1, 2]), ps_w)
+
+    def unproject(self, ps_p, idx_cam):
+        ps_p = _float(ps_p)
+        A, model, d, R, t = self.params(idx_cam, ps_p)
+
+        # Invert camera matrix and undistort
+        ys = (ps_p[..., 1] - A[1, 2])/A[1, 1]
+        xs = (ps_p[..., 0] - A[0, 2] - A[0, 1]*ys)/A[0, 0]
+        if model in _distorts: xs, ys = _undistort(xs, ys, d, *_distorts[model], self.cutoff_it, self.cutoff_norm)
+
+        # Camera => world coordinates
+        return t, _stack((xs, ys, xs*0 + 1), ps_p)@R.T
+
+# Cell
+def load_projector(file_params, **kwargs):
+    params = load_params(file_params)
+    return Projector(params['As'], params['distorts'], params['Ms_cam'], **kwargs)
\ No newline at end of file
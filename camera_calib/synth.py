@@ -0,0 +1,205 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: synth.ipynb (unless otherwise specified).
+
+__all__ = ['synth_scene', 'synth_occluders', 'synth_ps', 'synth_obs', 'synth_array', 'SynthImg', 'synth_imgs',
+           'write_imgs', 'SynthDetector']
+
+# Cell
+import math
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from .cb_geom import CpCSRGrid
+from .image import Img
+from .modules import *
+from .runtime import Projector
+from .utils import *
+
+# Cell
+def _rand(sz, lim, dtype, generator): return (2*torch.rand(sz, dtype=dtype, generator=generator) - 1)*lim
+
+# Cell
+def _Ms(rigids): return torch.stack([rigid.get_param().detach() for rigid in rigids])
+
+# Cell
+def synth_scene(cb_geom,
+                num_cam,
+                num_cb,
+                sz=(1536, 2048),
+                alpha=3600,
+                d=(-0.1, 0.1, 0, 0),
+                Distortion=Heikkila97Distortion,
+                angle_cam=math.radians(30),
+                angle_cb=math.radians(30),
+                jitter=0.05,
+                dist=None,
+                dtype=torch.double,
+                generator=None):
+    h, w = sz
+    if dist is None: dist = alpha*max(cb_geom.h_cb, cb_geom.w_cb)/(min(sz)/2) # Board spans about half the image
+
+    # Cameras look at a point in front of the first camera
+    eulers_cam = _rand((num_cam, 3), angle_cam, dtype, generator)
+    eulers_cam[0] = 0
+    Rs_cam = euler2R_batch(eulers_cam)
+    p = torch.tensor([0, 0, dist], dtype=dtype)
+    ts_cam = p - Rs_cam[:, :, 2]*dist*(1 + _rand((num_cam, 1), jitter, dtype, generator))
+    ts_cam[0] = 0
+
+    # Intrinsics
+    alphas = alpha*(1 + _rand(num_cam, jitter, dtype, generator))
+    xs_o = (w-1)/2 + _rand(num_cam, jitter*w/2, dtype, generator)
+    ys_o = (h-1)/2 + _rand(num_cam, jitter*h/2, dtype, generator)
+
+    # Boards are placed around the point
+    Rs_cb = euler2R_batch(_rand((num_cb, 3), angle_cb, dtype, generator))
+    ts_cb = p + _rand((num_cb, 3), 0.1*dist, dtype, generator)
+
+    return {'cams':       [CamSF(a2A(alpha, alpha, x_o, y_o)) for alpha, x_o, y_o in zip(alphas, xs_o, ys_o)],
+            'distorts':   [NoDistortion() if Distortion is NoDistortion else Distortion(torch.tensor(d, dtype=dtype))
+                           for _ in range(num_cam)],
+            'rigids_cam': [Rigid(R, t) for R, t in zip(Rs_cam, ts_cam)],
+            'rigids_cb':  [Rigid(R, t) for R, t in zip(Rs_cb, ts_cb)],
+            'sz':         sz}
+
+# Cell
+def synth_occluders(cb_geom, num_view, num_occluder=1, r=None, dtype=torch.double, generator=None):
+    if r is None: r = min(cb_geom.h_cb, cb_geom.w_cb)/8
+    xs = _rand((num_view, num_occluder), cb_geom.w_cb/2, dtype, generator)
+    ys = _rand((num_view, num_occluder), cb_geom.h_cb/2, dtype, generator)
+    rs = torch.rand((num_view, num_occluder), dtype=dtype, generator=generator)*r
+    return torch.stack([xs, ys, rs], dim=2)
+
+# Cell
+def synth_ps(scene, ps_b, idxs_cam, idxs_cb, noise=0, occluders=None, generator=None):
+    h, w = scene['sz']
+    ps_b = ps_b.detach()
+    ps_w = torch.cat([ps_b, ps_b.new_zeros(len(ps_b), 1)], dim=1)
+    with torch.no_grad():
+        rig = Rig(scene['cams'], scene['distorts'], scene['rigids_cb'], idxs_cb, scene['rigids_cam'], idxs_cam)
+        pss_p = rig(ps_w)
+
+    # Board => camera coordinates
+    Ms_cam, Ms_cb = _Ms(scene['rigids_cam'])[idxs_cam], _Ms(scene['rigids_cb'])[idxs_cb]
+    Rs = Ms_cam[:, :3, :3].transpose(1, 2)@Ms_cb[:, :3, :3]
+    ts = (Ms_cb[:, :3, 3] - Ms_cam[:, :3, 3])[:, None]@Ms_cam[:, :3, :3]
+    pss = pmm_batch(ps_w.expand(len(Rs), -1, -1), Rs) + ts
+
+    # Check visibility
+    mask = (pss[:, :, 2] > 0) & ((pss*Rs[:, None, :, 2]).sum(dim=2) > 0)
+    mask &= (pss_p[:, :, 0] >= 0) & (pss_p[:, :, 0] <= w-1) & (pss_p[:, :, 1] >= 0) & (pss_p[:, :, 1] <= h-1)
+    if occluders is not None:
+        mask &= (((ps_b[None, :, None] - occluders[:, None, :, :2])**2).sum(dim=3) >= occluders[:, None, :, 2]**2).all(dim=2)
+
+    if noise > 0: pss_p = pss_p + noise*torch.randn(pss_p.shape, dtype=pss_p.dtype, generator=generator)
+    pss_p[~mask] = np.nan
+    return pss_p
+
+# Cell
+def synth_obs(cb_geom, scene, idxs_cam, idxs_cb, **kwargs):
+    return synth_ps(scene, cb_geom.ps_c(scene['cams'][0].a.dtype), idxs_cam, idxs_cb, **kwargs)
+
+# Cell
+def _projector(scene):
+    return Projector(torch.stack([cam.get_param().detach() for cam in scene['cams']]).numpy(),
+                     [{'model': 'NoDistortion', 'd': []} if isinstance(distort, NoDistortion) else
+                      {'model': type(distort).__name__, 'd': distort.d.detach().numpy()} for distort in scene['distorts']],
+                     _Ms(scene['rigids_cam']).numpy())
+
+# Cell
+def _intensity(cb_geom, ps, occluders=None):
+    if not isinstance(cb_geom.cp_geom, CpCSRGrid): raise RuntimeError(f'Dont know how to handle: {type(cb_geom.cp_geom)}')
+    xs, ys = ps.unbind(-1)
+    vals = torch.where((xs.abs() <= cb_geom.w_cb/2) & (ys.abs() <= cb_geom.h_cb/2), ps.new_tensor(0.8), ps.new_tensor(0.05))
+
+    # Checker squares surround control points
+    num_h, num_w, spacing = cb_geom.cp_geom.num_h, cb_geom.cp_geom.num_w, cb_geom.cp_geom.spacing
+    idxs_x, idxs_y = torch.floor(xs/spacing + (num_w+1)/2), torch.floor(ys/spacing + (num_h+1)/2)
+    vals[(idxs_x >= 0) & (idxs_x <= num_w) & (idxs_y >= 0) & (idxs_y <= num_h) & ((idxs_x + idxs_y)%2 == 0)] = 0.1
+
+    # Fiducial markers; radii are relative to the checker spacing
+    if cb_geom.fm_geom is not None:
+        for x, y in cb_geom.ps_f(ps.dtype, ps.device)/spacing:
+            rs = (xs/spacing - x)**2 + (ys/spacing - y)**2
+            vals[(rs < 0.25**2) | ((rs > 0.5**2) & (rs < 0.75**2))] = 0.1
+
+    if occluders is not None:
+        for x, y, r in occluders: vals[(xs - x)**2 + (ys - y)**2 < r**2] = 0.3
+    return vals
+
+# Cell
+def synth_array(cb_geom, scene, idx_cam, idx_cb, occluders=None, noise=0, supersample=2, generator=None):
+    h, w = scene['sz']
+    projector = _projector(scene)
+    M_cb = scene['rigids_cb'][idx_cb].get_param().detach()
+    arr = torch.full((h, w), 0.05, dtype=M_cb.dtype)
+
+    # Get bounding box of the board's outline
+    b = bb2b(torch.tensor([[-cb_geom.w_cb/2, -cb_geom.h_cb/2], [cb_geom.w_cb/2, cb_geom.h_cb/2]], dtype=arr.dtype))
+    ts = torch.linspace(0, 1, 33, dtype=arr.dtype)[:-1, None]
+    ps_b = torch.cat([p1 + ts*(p2 - p1) for p1, p2 in zip(b, b.roll(-1, 0))])
+    ps_w = pmm(torch.cat([ps_b, ps_b.new_zeros(len(ps_b), 1)], dim=1), M_cb, aug=True)
+    M_cam = projector.Ms_cam[idx_cam]
+    if ((ps_w.numpy() - M_cam[:3, 3])@M_cam[:3, 2] > 0).all():
+        ps_p = projector.project(ps_w, idx_cam)
+        (x1, y1), (x2, y2) = ps_p.min(dim=0).values.floor() - 1, ps_p.max(dim=0).values.ceil() + 1
+        x1, y1, x2, y2 = max(int(x1), 0), max(int(y1), 0), min(int(x2), w-1), min(int(y2), h-1)
+    else: x1, y1, x2, y2 = 0, 0, w-1, h-1 # Board crosses the camera plane, so render everything
+
+    if x1 <= x2 and y1 <= y2:
+        # Intersect rays of sampled pixels with the board
+        offsets = (torch.arange(supersample, dtype=arr.dtype) + 0.5)/supersample - 0.5
+        xs = (torch.arange(x1, x2+1, dtype=arr.dtype)[:, None] + offsets).reshape(-1)
+        ys = (torch.arange(y1, y2+1, dtype=arr.dtype)[:, None] + offsets).reshape(-1)
+        o, ds = projector.unproject(grid2ps(*reverse(torch.meshgrid(ys, xs))), idx_cam)
+        R, t = M_cb[:3, :3], M_cb[:3, 3]
+        o, ds = (o - t)@R, ds@R
+        ss = -o[2]/ds[:, 2]
+        vals = _intensity(cb_geom, o[:2] + ss[:, None]*ds[:, :2], occluders)
+        vals[~(ss > 0)] = 0.05
+        arr[y1:y2+1, x1:x2+1] = vals.reshape(y2-y1+1, supersample, x2-x1+1, supersample).mean(dim=(1, 3))
+
+    if noise > 0: arr += noise*torch.randn(arr.shape, dtype=arr.dtype, generator=generator)
+    return arr.clamp(0, 1)
+
+# Cell
+class SynthImg(Img):
+    def __init__(self, cb_geom, scene, idx_cam, idx_cb, occluders=None, noise=0, supersample=2, seed=0):
+        self.cb_geom, self.scene, self.idx_cam, self.idx_cb = cb_geom, scene, idx_cam, idx_cb
+        self.occluders, self.noise, self.supersample, self.seed = occluders, noise, supersample, seed
+
+    @property
+    def name(self): return f'SYNTH_CAM_{self.idx_cam+1}_FRAMEID_0_COUNTER_{self.idx_cb+1}'
+    @property
+    def size(self): return tuple(self.scene['sz'])
+    def exists(self): return True
+
+    def array16bit(self):
+        arr = synth_array(self.cb_geom, self.scene, self.idx_cam, self.idx_cb, self.occluders, self.noise, self.supersample,
+                          torch.Generator().manual_seed(self.seed))
+        return (arr*(2**16-1)).round().numpy().astype(np.uint16)
+    def array(self, dtype, device=None): return torch.as_tensor(self.array16bit()/(2**16-1), dtype=dtype, device=device)
+
+# Cell
+def synth_imgs(cb_geom, scene, idxs_cam, idxs_cb, occluders=None, **kwargs):
+    return [SynthImg(cb_geom, scene, int(idx_cam), int(idx_cb), None if occluders is None else occluders[idx], seed=idx, **kwargs)
+            for idx, (idx_cam, idx_cb) in enumerate(zip(idxs_cam, idxs_cb))]
+
+# Cell
+def write_imgs(imgs, dir_imgs):
+    from PIL import Image
+
+    dir_imgs = Path(dir_imgs)
+    dir_imgs.mkdir(parents=True, exist_ok=True)
+    for img in imgs: Image.fromarray(img.array16bit()).save(dir_imgs/f'{img.name}.png')
+
+# Cell
+class SynthDetector:
+    def __init__(self, noise=0, seed=0): self.noise, self.seed = noise, seed
+
+    def detect_imgs(self, imgs, dtype, device):
+        generator = torch.Generator().manual_seed(self.seed)
+        return [synth_ps(img.scene, img.cb_geom.ps_f(img.scene['cams'][0].a.dtype), torch.tensor([img.idx_cam]),
+                         torch.tensor([img.idx_cb]), self.noise, generator=generator)[0].to(dtype=dtype, device=device)
+                for img in imgs]
\ No newline at end of file
@@ -1,38 +1,33 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: utils.ipynb (unless otherwise specified).
 
-__all__ = ['args_loop', 'Formatter', 'Torch2np', 'torch2np', 'Np2torch', 'np2torch', 'numpyify', 'assert_allclose',
-           'assert_allclose_f', 'assert_allclose_f_ttn', 'reverse', 'shape', 'stackify', 'delete', 'rescale',
-           'singlify', 'augment', 'deaugment', 'normalize', 'ps_bb', 'array_bb', 'bb_sz', 'bb_grid', 'bb_array',
-           'is_p_in_bb', 'is_bb_in_bb', 'is_p_in_b', 'bb2b', 'grid2ps', 'array_ps', 'crrgrid', 'csrgrid', 'csdgrid',
-           'cfpgrid', 'unitize', 'cross_mat', 'pmm', 'condition_mat', 'condition', 'homography', 'approx_R', 'euler2R',
-           'R2euler', 'rodrigues2R', 'R2rodrigues', 'approx_R', 'Rt2M', 'M2Rt', 'invert_rigid', 'mult_rigid',
-           'random_unit', 'v_v_angle', 'v_v_R', 'pm2l', 'ps2l', 'pld', 'l_l_intersect', 'b_ls', 'b_l_intersect',
-           'sample_2pi', 'sample_ellipse', 'ellipse2conic', 'conic2ellipse', 'rgb2gray', 'imresize', 'conv2d', 'pad',
-           'grad_array', 'interp_array', 'wlstsq', 'get_colors', 'get_notebook_file', 'save_notebook', 'build_notebook',
-           'convert_notebook']
-
-# Cell
+__all__ = ['args_loop', 'Formatter', 'Torch2np', 'torch2np', 'Np2torch', 'np2torch', 'numpyify', 'torch_only',
+           'assert_allclose', 'assert_allclose_f', 'assert_allclose_f_ttn', 'reverse', 'shape', 'stackify', 'delete',
+           'rescale', 'singlify', 'augment', 'deaugment', 'normalize', 'ps_bb', 'array_bb', 'bb_sz', 'bb_grid',
+           'bb_array', 'is_p_in_bb', 'is_bb_in_bb', 'is_p_in_b', 'is_ps_in_bs', 'bb2b', 'grid2ps', 'array_ps',
+           'crrgrid', 'csrgrid', 'csdgrid', 'cfpgrid', 'unitize', 'cross_mat', 'pmm', 'pmm_batch', 'condition_mat',
+           'condition', 'condition_mat_batch', 'homography', 'homography_batch', 'approx_R', 'approx_R_batch',
+           'euler2R', 'euler2R_batch', 'euler2R_jacobian_batch', 'R2euler', 'rodrigues2R', 'R2rodrigues', 'approx_R',
+           'Rt2M', 'M2Rt', 'invert_rigid', 'mult_rigid', 'random_unit', 'v_v_angle', 'v_v_R', 'pm2l', 'ps2l', 'pld',
+           'l_l_intersect', 'b_ls', 'b_l_intersect', 'sample_2pi', 'sample_ellipse', 'ellipse2conic', 'conic2ellipse',
+           'conic2ellipse_batch', 'rgb2gray', 'imresize', 'conv2d', 'pad', 'grad_array', 'grad_array_batch',
+           'interp_array', 'wlstsq', 'wlstsq_batch', 'get_colors', 'get_notebook_file', 'save_notebook',
+           'build_notebook', 'convert_notebook']
+
+# Cell
+import functools
 import hashlib
 import json
 import math
 import os
 import re
+import threading
 import time
 import warnings
+from contextlib import contextmanager
 from pathlib import Path
 
-import ipykernel
-import nbdev.export
 import numpy as np
-import requests
-import seaborn as sns
 import torch
-from IPython.display import Javascript, display
-from notebook.notebookapp import list_running_servers
-from PIL import Image
-from shapely.geometry import Point
-from shapely.geometry.polygon import Polygon
-from torchvision import transforms
 
 # Cell
 def args_loop(args, callback):
@@ -73,6 +68,7 @@ np2torch = Np2torch()
 # Cell
 def numpyify(f):
     def _numpyify(*args, **kwargs):
+        if _torch_only.on: return f(*args, **kwargs) # Fast path
         np2torch = Np2torch()                      # For thread safety, make a local instantiation
         args, kwargs = np2torch((args, kwargs))
         out = f(*args, **kwargs)
@@ -80,6 +76,16 @@ def numpyify(f):
         return out
     return _numpyify
 
+# Cell
+class _TorchOnly(threading.local): on = False
+_torch_only = _TorchOnly()
+
+@contextmanager
+def torch_only():
+    on, _torch_only.on = _torch_only.on, True
+    try:     yield
+    finally: _torch_only.on = on
+
 # Cell
 def _assert_allclose(A, B, **kwargs):
     if isinstance(A, tuple):
@@ -187,7 +193,23 @@ def is_p_in_bb(p, bb): return p[0] >= bb[0,0] and p[1] >= bb[0,1] and p[0] <= bb
 def is_bb_in_bb(bb1, bb2): return is_p_in_bb(bb1[0], bb2) and is_p_in_bb(bb1[1], bb2)
 
 # Cell
-def is_p_in_b(p, b): return Polygon(b).contains(Point(*p))
+@functools.lru_cache(maxsize=None)
+def _shapely_geometry(): # Import shapely once, on first use, rather than once per point
+    import shapely.geometry
+    return shapely.geometry
+
+def is_p_in_b(p, b):
+    geometry = _shapely_geometry()
+    return geometry.Polygon(b).contains(geometry.Point(*p))
+
+# Cell
+@numpyify
+def is_ps_in_bs(ps, bs):
+    xs, ys = ps[..., None, 0], ps[..., None, 1]
+    (x1s, y1s), (x2s, y2s) = bs.unbind(-1), bs.roll(-1, dims=-2).unbind(-1)
+    crosses = (y1s > ys) != (y2s > ys)
+    xs_int = (x2s-x1s)*(ys-y1s)/(y2s-y1s) + x1s # Only valid where crosses is True
+    return (crosses & (xs < xs_int)).sum(dim=-1) % 2 == 1
 
 # Cell
 def bb2b(bb): return bb[[[0,0],[0,1],[1,1],[1,0]],
@@ -255,6 +277,14 @@ def pmm(ps, A, aug=False):
     if aug: ps = normalize(ps) # works for both affine and homography transforms
     return ps
 
+# Cell
+@numpyify
+def pmm_batch(pss, As, aug=False):
+    if aug: pss = torch.cat([pss, pss.new_ones(*pss.shape[:2], 1)], dim=2)
+    pss = (As@pss.transpose(1, 2)).transpose(1, 2)
+    if aug: pss = pss[:, :, :-1]/pss[:, :, -1:]
+    return pss
+
 # Cell
 @numpyify
 def condition_mat(ps):
@@ -272,6 +302,20 @@ def condition(ps):
     T = condition_mat(ps)
     return pmm(ps, T, aug=True), T
 
+# Cell
+@numpyify
+def condition_mat_batch(pss, masks=None):
+    if masks is None: masks = torch.ones(pss.shape[:2], dtype=torch.bool, device=pss.device)
+
+    pss = pss.masked_fill(~masks[:, :, None], 0) # Masked points can be NaN
+    ns = masks.sum(dim=1).to(pss.dtype)
+    means = pss.sum(dim=1)/ns[:, None]
+    s_ms = math.sqrt(2)*ns/(torch.norm(pss-means[:, None], dim=2)*masks).sum(dim=1)
+    Ts = torch.eye(3, dtype=pss.dtype, device=pss.device).repeat(len(pss), 1, 1)
+    Ts[:, 0, 0], Ts[:, 1, 1] = s_ms, s_ms
+    Ts[:, 0:2, 2] = -means*s_ms[:, None]
+    return Ts
+
 # Cell
 @numpyify
 def homography(ps1, ps2):
@@ -291,6 +335,32 @@ def homography(ps1, ps2):
     H12 = H12/H12[2,2] # Sets H12[2,2] to 1
     return H12
 
+# Cell
+@numpyify
+def homography_batch(pss1, pss2, masks=None):
+    if masks is None: masks = torch.ones(pss1.shape[:2], dtype=torch.bool, device=pss1.device)
+    masks = masks & torch.isfinite(pss1).all(dim=2) & torch.isfinite(pss2).all(dim=2)
+
+    # Condition and augment points; masked points are zeroed so they dont contribute to the system
+    Ts1, Ts2 = condition_mat_batch(pss1, masks), condition_mat_batch(pss2, masks)
+    pss1_cond = torch.cat([pmm_batch(pss1, Ts1, aug=True), pss1.new_ones(*pss1.shape[:2], 1)], dim=2)
+    pss2_cond = pmm_batch(pss2, Ts2, aug=True)
+    pss1_cond = pss1_cond.masked_fill(~masks[:, :, None], 0)
+    pss2_cond = pss2_cond.masked_fill(~masks[:, :, None], 0)
+
+    # Form homogeneous systems
+    zeros = torch.zeros_like(pss1_cond)
+    Ls = torch.cat([torch.cat([pss1_cond, zeros, -pss2_cond[:, :, 0:1]*pss1_cond], dim=2),
+                    torch.cat([zeros, pss1_cond, -pss2_cond[:, :, 1:2]*pss1_cond], dim=2)], dim=1)
+
+    # Solution is the eigenvector of the symmetric normal matrix with the smallest eigenvalue; eigh sorts ascending
+    Hs12_cond = torch.linalg.eigh(Ls.transpose(1, 2)@Ls).eigenvectors[:, :, 0].reshape(-1, 3, 3)
+
+    # Undo conditioning
+    Hs12 = torch.inverse(Ts2)@Hs12_cond@Ts1
+    Hs12 = Hs12/Hs12[:, 2:, 2:] # Sets Hs12[:, 2, 2] to 1
+    return Hs12
+
 # Cell
 @numpyify
 def approx_R(R):
@@ -302,6 +372,13 @@ def approx_R(R):
         R = R.new_full((3,3), math.nan)
     return R
 
+# Cell
+@numpyify
+def approx_R_batch(Rs):
+    Us, _, Vs = torch.svd(Rs)
+    Rs = Us@Vs.transpose(1, 2)
+    return Rs.masked_fill(~torch.isclose(torch.det(Rs), Rs.new_tensor(1))[:, None, None], math.nan)
+
 # Cell
 @numpyify
 def euler2R(euler):
@@ -314,6 +391,33 @@ def euler2R(euler):
         (      -s(e_y),                        c(e_y)*s(e_x),                        c(e_x)*c(e_y))
     ))
 
+# Cell
+@numpyify
+def euler2R_batch(eulers):
+    s, c = torch.sin, torch.cos
+
+    e_x, e_y, e_z = eulers.T
+    return stackify((
+        (c(e_y)*c(e_z), c(e_z)*s(e_x)*s(e_y) - c(e_x)*s(e_z), s(e_x)*s(e_z) + c(e_x)*c(e_z)*s(e_y)),
+        (c(e_y)*s(e_z), c(e_x)*c(e_z) + s(e_x)*s(e_y)*s(e_z), c(e_x)*s(e_y)*s(e_z) - c(e_z)*s(e_x)),
+        (      -s(e_y),                        c(e_y)*s(e_x),                        c(e_x)*c(e_y))
+    ), dim=1)
+
+# Cell
+@numpyify
+def euler2R_jacobian_batch(eulers):
+    s, c = torch.sin, torch.cos
+
+    e_x, e_y, e_z = eulers.T
+    zeros, ones = torch.zeros_like(e_x), torch.ones_like(e_x)
+    Rxs  = stackify(((  ones,   zeros,    zeros), (  zeros,  c(e_x),  -s(e_x)), (  zeros, s(e_x),  c(e_x))), dim=1)
+    Rys  = stackify(((c(e_y),   zeros,   s(e_y)), (  zeros,    ones,    zeros), (-s(e_y),  zeros,  c(e_y))), dim=1)
+    Rzs  = stackify(((c(e_z), -s(e_z),    zeros), ( s(e_z),  c(e_z),    zeros), (  zeros,  zeros,    ones)), dim=1)
+    dRxs = stackify((( zeros,   zeros,    zeros), (  zeros, -s(e_x),  -c(e_x)), (  zeros, c(e_x), -s(e_x))), dim=1)
+    dRys = stackify(((-s(e_y),  zeros,   c(e_y)), (  zeros,   zeros,    zeros), (-c(e_y),  zeros, -s(e_y))), dim=1)
+    dRzs = stackify(((-s(e_z), -c(e_z),   zeros), ( c(e_z), -s(e_z),    zeros), (  zeros,  zeros,   zeros)), dim=1)
+    return stackify((Rzs@Rys@dRxs, Rzs@dRys@Rxs, dRzs@Rys@Rxs), dim=1)
+
 # Cell
 @numpyify
 def R2euler(R):
@@ -537,6 +641,39 @@ def conic2ellipse(Aq):
 
     return stackify((h, k, a, b, alpha))
 
+# Cell
+@numpyify
+def conic2ellipse_batch(Aqs):
+    A = Aqs[:, 0, 0]
+    B = 2*Aqs[:, 0, 1]
+    C = Aqs[:, 1, 1]
+    D = 2*Aqs[:, 0, 2]
+    E = 2*Aqs[:, 1, 2]
+    F = Aqs[:, 2, 2]
+
+    # Equations below are from https://math.stackexchange.com/a/820896/39581
+    q = 64*(F*(4*A*C-B**2)-A*E**2+B*D*E-C*D**2)/(4*A*C-B**2)**2
+    s = 1/4*torch.sqrt(torch.abs(q)*torch.sqrt(B**2+(A-C)**2))
+    h = (B*E-2*C*D)/(4*A*C-B**2)
+    k = (B*D-2*A*E)/(4*A*C-B**2)
+    a = 1/8*torch.sqrt(2*torch.abs(q)*torch.sqrt(B**2+(A-C)**2)-2*q*(A+C))
+    b = torch.sqrt(a**2-s**2)
+
+    # Get alpha; conditions are applied in reverse order of precedence from conic2ellipse
+    def _isclose(x): return torch.isclose(x, torch.zeros_like(x))
+    qAC, qB = q*A-q*C, q*B
+    alpha = 1/2*torch.atan(B/(A-C))
+    alpha = torch.where(qAC < 0,                                 alpha + 1/2*math.pi, alpha)
+    alpha = torch.where((qAC > 0) & (qB < 0),                    alpha + math.pi,     alpha)
+    alpha = torch.where(_isclose(qAC) & (qB < 0),                torch.full_like(q, 3/4*math.pi), alpha)
+    alpha = torch.where(_isclose(qAC) & (qB > 0),                torch.full_like(q, 1/4*math.pi), alpha)
+    alpha = torch.where(_isclose(qAC) & _isclose(qB),            torch.zeros_like(q), alpha)
+
+    # Return nans if input conic is not ellipse
+    es = stackify((h, k, a, b, alpha), dim=1)
+    invalid = ~torch.isfinite(Aqs).flatten(1).all(dim=1) | _isclose(B**2-4*A*C) | (B**2-4*A*C > 0)
+    return es.masked_fill(invalid[:, None], math.nan)
+
 # Cell
 def rgb2gray(arr): # From Pillow documentation
     return arr[:,:,0]*(299/1000) + arr[:,:,1]*(587/1000) + arr[:,:,2]*(114/1000)
@@ -569,6 +706,16 @@ def grad_array(arr):
     arr = pad(arr, pad=(1,1,1,1), mode='replicate')
     return tuple(conv2d(arr, kernel) for kernel in (kernel_sobel, kernel_sobel.T))
 
+# Cell
+@numpyify
+def grad_array_batch(arrs):
+    kernel_sobel = arrs.new_tensor([[-0.1250, 0, 0.1250],
+                                    [-0.2500, 0, 0.2500],
+                                    [-0.1250, 0, 0.1250]])
+    arrs = torch.nn.functional.pad(arrs[:, None], pad=(1,1,1,1), mode='replicate')
+    return tuple(torch.nn.functional.conv2d(arrs, kernel[None, None]).squeeze(1)
+                 for kernel in (kernel_sobel, kernel_sobel.T))
+
 # Cell
 @numpyify
 def interp_array(arr, ps, align_corners=True, **kwargs):
@@ -592,10 +739,29 @@ def wlstsq(A, b, W=None):
     return x
 
 # Cell
-def get_colors(n): return sns.color_palette(None, n)
+@numpyify
+def wlstsq_batch(A, b, W=None):
+    single = len(b.shape) == 2
+    if single: b = b[:, :, None]
+    if W is not None: # Weight matrix is a diagonal matrix with sqrt of the input weights
+        W = torch.sqrt(W.reshape(len(W), -1, 1))
+        A, b = A*W, b*W
+    x = torch.pinverse(A)@b
+    if single: x = x.squeeze(2)
+    return x
+
+# Cell
+def get_colors(n):
+    import seaborn as sns
+
+    return sns.color_palette(None, n)
 
 # Cell
 def get_notebook_file():
+    import ipykernel
+    import requests
+    from notebook.notebookapp import list_running_servers
+
     id_kernel = re.search('kernel-(.*).json', ipykernel.connect.get_connection_file()).group(1)
     for server in list_running_servers():
         response = requests.get(requests.compat.urljoin(server['url'], 'api/sessions'),
@@ -606,6 +772,8 @@ def get_notebook_file():
 
 # Cell
 def save_notebook():
+    from IPython.display import Javascript, display
+
     file_notebook = get_notebook_file()
     _get_md5 = lambda : hashlib.md5(file_notebook.read_bytes()).hexdigest()
     md5_start = _get_md5()
@@ -614,6 +782,8 @@ def save_notebook():
 
 # Cell
 def build_notebook(save=True):
+    import nbdev.export
+
     if save: save_notebook()
     nbdev.export.notebook2script(fname=get_notebook_file().as_posix())
 